@@ -1,9 +1,13 @@
 import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from datetime import datetime, timedelta
+from fastapi import Request
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError
 from pymongo.server_api import ServerApi
 
 class Database:
-    client: AsyncIOMotorClient = None
+    client: AsyncMongoClient = None
     database = None
 
 db = Database()
@@ -11,6 +15,10 @@ db = Database()
 async def get_database():
     return db.database
 
+async def get_db(request: Request) -> AsyncDatabase:
+    """Request dependency returning the database handle stored on the app at startup"""
+    return request.app.state.db
+
 async def connect_to_mongo():
     """Create database connection"""
     mongodb_uri = os.getenv("MONGODB_URI")
@@ -20,7 +28,7 @@ async def connect_to_mongo():
         print("⚠️  No MONGODB_URI found in environment variables")
         return
     
-    db.client = AsyncIOMotorClient(
+    db.client = AsyncMongoClient(
         mongodb_uri,
         server_api=ServerApi('1'),
         connectTimeoutMS=30000,  # 30 second connection timeout
@@ -37,8 +45,98 @@ async def connect_to_mongo():
         print(f"❌ Error connecting to MongoDB: {e}")
         raise
 
+# Case-insensitive collation shared by the user search query and its indexes
+CASE_INSENSITIVE_COLLATION = {"locale": "en", "strength": 2}
+
+# (collection, keys, options) for every index the API's queries rely on
+INDEXES = [
+    # Case-insensitive indexes used by the prefix search in GET /api/users
+    ("users", [("name", 1)], {"name": "name_ci", "collation": CASE_INSENSITIVE_COLLATION}),
+    ("users", [("username", 1)], {"name": "username_ci", "collation": CASE_INSENSITIVE_COLLATION}),
+    ("users", [("email", 1)], {"name": "email_ci", "collation": CASE_INSENSITIVE_COLLATION}),
+    ("users", [("email", 1)], {"unique": True}),
+    ("users", [("username", 1)], {"unique": True, "partialFilterExpression": {"username": {"$type": "string"}}}),
+    ("users", [("created_at", -1), ("_id", -1)], {}),
+    ("blogs", [("author_id", 1), ("created_at", -1), ("_id", -1)], {}),
+    # One index per community list filter and COMMUNITY_SORT_MAPPING sort key. _id is the
+    # keyset pagination tie-break; ascending sorts walk these indexes backwards.
+    ("communities", [("members", 1), ("created_at", -1), ("_id", -1)], {}),
+    ("communities", [("members", 1), ("member_count", -1), ("_id", -1)], {}),
+    ("communities", [("members", 1), ("name", 1), ("_id", 1)], {}),
+    ("communities", [("creator_id", 1), ("created_at", -1), ("_id", -1)], {}),
+    ("communities", [("creator_id", 1), ("member_count", -1), ("_id", -1)], {}),
+    ("communities", [("creator_id", 1), ("name", 1), ("_id", 1)], {}),
+    ("user_presence", [("user_id", 1)], {"unique": True}),
+    # Startup seeding checks and the category listings (active categories by name)
+    ("categories", [("is_active", 1), ("name", 1)], {}),
+    ("blog_categories", [("is_active", 1), ("name", 1)], {}),
+    # Active category names are unique (matching the is_active duplicate checks), so
+    # default seeding can upsert on them from every worker; soft-deleted categories
+    # don't hold on to their names
+    ("categories", [("name", 1)], {"name": "name_active_unique", "unique": True, "partialFilterExpression": {"is_active": True}}),
+    ("blog_categories", [("name", 1)], {"name": "name_active_unique", "unique": True, "partialFilterExpression": {"is_active": True}}),
+]
+
+async def create_indexes():
+    """Create the indexes backing the API's queries (no-op if they already exist)"""
+    if db.database is None:
+        return
+    
+    for collection, keys, options in INDEXES:
+        try:
+            await db.database[collection].create_index(keys, **options)
+        except Exception as e:
+            # The user create/update endpoints rely on the unique user indexes to
+            # reject duplicate emails and usernames, so those must exist
+            if collection == "users" and options.get("unique"):
+                print(f"❌ Error creating required unique index {keys} on {collection}: {e}")
+                raise
+            # Don't block startup for the other indexes
+            print(f"⚠️  Error creating index {keys} on {collection}: {e}")
+    
+    print("✅ Database indexes ensured")
+
+# A claimed migration marker without completed_at that is older than this is
+# assumed to belong to a process that died mid-run, and may be claimed again
+MIGRATION_CLAIM_TIMEOUT = timedelta(minutes=30)
+
+async def run_migration_once(name: str, migrate) -> None:
+    """Run a one-off data migration unless its marker document in ``migrations`` exists
+    
+    The marker is claimed before running, so when several workers start together
+    only one of them migrates. A failed run removes its marker, and a stale
+    unfinished claim is taken over, so the migration is retried on a later startup.
+    """
+    if db.database is None:
+        return
+    
+    now = datetime.utcnow()
+    try:
+        await db.database.migrations.insert_one({"_id": name, "started_at": now})
+    except DuplicateKeyError:
+        reclaimed = await db.database.migrations.find_one_and_update(
+            {
+                "_id": name,
+                "completed_at": {"$exists": False},
+                "started_at": {"$lt": now - MIGRATION_CLAIM_TIMEOUT}
+            },
+            {"$set": {"started_at": now}}
+        )
+        if reclaimed is None:
+            return
+    
+    try:
+        await migrate(db.database)
+    except Exception as e:
+        await db.database.migrations.delete_one({"_id": name})
+        print(f"⚠️  Migration {name} failed: {e}")
+        return
+    
+    await db.database.migrations.update_one({"_id": name}, {"$set": {"completed_at": datetime.utcnow()}})
+    print(f"✅ Migration {name} applied")
+
 async def close_mongo_connection():
     """Close database connection"""
     if db.client:
-        db.client.close()
+        await db.client.close()
         print("🔌 Disconnected from MongoDB") 
\ No newline at end of file
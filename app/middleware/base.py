@@ -0,0 +1,47 @@
+import json
+from typing import Any
+
+class ASGIMiddleware:
+    """Base class for request-scoped middleware written against raw ASGI
+    
+    New middleware (timing, logging, auth, ...) should subclass this rather than
+    Starlette's BaseHTTPMiddleware, which builds Request/Response objects and runs
+    the rest of the app in an extra task on every request. Subclasses override
+    handle_http(); lifespan and websocket scopes pass straight through.
+    
+    To change the response, wrap ``send``::
+    
+        async def handle_http(self, scope, receive, send):
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message["headers"], (b"x-example", b"1")]
+                await send(message)
+            
+            await self.app(scope, receive, send_wrapper)
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        await self.handle_http(scope, receive, send)
+    
+    async def handle_http(self, scope, receive, send):
+        await self.app(scope, receive, send)
+
+async def send_json(send, status_code: int, content: Any):
+    """Write a complete JSON response straight to ``send`` to short-circuit a request"""
+    body = json.dumps(content, separators=(",", ":")).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode())
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
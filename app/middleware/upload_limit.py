@@ -0,0 +1,60 @@
+from typing import Dict
+from fastapi import HTTPException, status
+from app.middleware.base import ASGIMiddleware, send_json
+
+# Allowance for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+TOO_LARGE_DETAIL = "Uploaded file is too large"
+
+class UploadSizeLimitMiddleware(ASGIMiddleware):
+    """Reject oversized uploads with 413 before their body is read
+    
+    FastAPI parses (and spools) a multipart body before the endpoint runs, so a size
+    check in the handler only happens after the whole upload has been received. This
+    pure ASGI middleware checks Content-Length up front and also counts the bytes
+    actually received, so a client that lies about (or omits) Content-Length is cut
+    off as soon as it goes past the limit.
+    """
+    
+    def __init__(self, app, limits: Dict[str, int]):
+        super().__init__(app)
+        # Path -> maximum file size in bytes
+        self.limits = {path: size + MULTIPART_OVERHEAD for path, size in limits.items()}
+    
+    async def handle_http(self, scope, receive, send):
+        if scope["path"] not in self.limits:
+            await self.app(scope, receive, send)
+            return
+        
+        max_body = self.limits[scope["path"]]
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                # A malformed value is treated like a missing header; the received
+                # bytes are still counted below
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    break
+                if content_length > max_body:
+                    await send_json(send, status.HTTP_413_CONTENT_TOO_LARGE, {"detail": TOO_LARGE_DETAIL})
+                    return
+                break
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    # Raised while FastAPI reads the body; it re-raises HTTPExceptions,
+                    # which the app's exception handling turns into the 413 response
+                    raise HTTPException(
+                        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                        detail=TOO_LARGE_DETAIL
+                    )
+            return message
+        
+        await self.app(scope, limited_receive, send)
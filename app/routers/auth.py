@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException, status, Header, Request
-from app.database import get_database
+from fastapi import APIRouter, HTTPException, status, Header, Request, Depends
+from app.database import get_db
 from typing import Dict, Any, Optional
 from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -16,11 +17,10 @@ class AuthVerifyRequest(BaseModel):
 @router.post("/verify")
 async def verify_auth(
     request: Request,
-    x_user_id: Optional[str] = Header(None, description="User ID from Clerk (frontend)")
+    x_user_id: Optional[str] = Header(None, description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Verify user authentication (placeholder endpoint for frontend)"""
-    db = await get_database()
-    
     # Try to get user ID from header first, then from request body
     user_id = x_user_id
     user_data = {}
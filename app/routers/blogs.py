@@ -1,12 +1,15 @@
-from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile
-from app.database import get_database
+from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile, Depends
+from app.database import get_db
 from app.models.blog import BlogCreate, BlogUpdate, BlogResponse
-from app.utils.helpers import convert_objectid_to_str, format_timestamp, sanitize_html
+from app.utils.helpers import format_timestamp, sanitize_html, ALLOWED_IMAGE_TYPES
+from app.utils.responses import MongoJSONResponse
 from typing import Optional, List
 from datetime import datetime
 from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError
 import secrets
-from firebase_admin import storage as fb_storage
+from app.storage.firebase import get_bucket
 
 router = APIRouter()
 
@@ -15,11 +18,11 @@ router = APIRouter()
 @router.post("/upload/image")
 async def upload_blog_image(
     file: UploadFile = File(...),
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Upload blog featured image to Firebase Storage"""
-    allowed_types = ["image/jpeg", "image/png", "image/jpg", "image/webp"]
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only JPEG, PNG, JPG, and WebP images are allowed"
@@ -34,7 +37,6 @@ async def upload_blog_image(
         )
     
     # Verify user exists
-    db = await get_database()
     user = await db.users.find_one({"_id": x_user_id})
     if not user and ObjectId.is_valid(x_user_id):
         user = await db.users.find_one({"_id": ObjectId(x_user_id)})
@@ -45,7 +47,7 @@ async def upload_blog_image(
         )
     
     # Upload to Firebase Storage
-    bucket = fb_storage.bucket()
+    bucket = get_bucket()
     file_extension = file.filename.split(".")[-1]
     unique_filename = f"blog_images/{secrets.token_hex(16)}.{file_extension}"
     blob = bucket.blob(unique_filename)
@@ -64,11 +66,10 @@ async def get_blogs(
     page: int = Query(1, ge=1),
     per_page: int = Query(10, ge=1, le=50),
     category: Optional[str] = Query(None),
-    author: Optional[str] = Query(None)
+    author: Optional[str] = Query(None),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get all blogs with pagination and filtering"""
-    db = await get_database()
-    
     # Build filter
     filter_query = {}
     if category:
@@ -116,6 +117,7 @@ async def get_blogs(
             }
     
     # Add author info to each blog
+    now = datetime.utcnow()
     for blog in blogs:
         blog["author"] = authors.get(blog["author_id"], {
             "id": blog["author_id"],
@@ -124,24 +126,23 @@ async def get_blogs(
             "avatar": "",
             "bio": ""
         })
-        blog["timestamp"] = format_timestamp(blog["created_at"])
+        blog["timestamp"] = format_timestamp(blog["created_at"], now)
     
-    return {
-        "blogs": convert_objectid_to_str(blogs),
+    return MongoJSONResponse({
+        "blogs": blogs,
         "total": total_count,
         "page": page,
         "per_page": per_page
-    }
+    })
 
 @router.get("/search")
 async def search_blogs(
     q: str = Query(..., min_length=1),
     page: int = Query(1, ge=1),
-    per_page: int = Query(10, ge=1, le=50)
+    per_page: int = Query(10, ge=1, le=50),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Search blogs by title, content, category, or author"""
-    db = await get_database()
-    
     skip = (page - 1) * per_page
     
     # Build search filter
@@ -192,6 +193,7 @@ async def search_blogs(
             }
     
     # Add author info to each blog
+    now = datetime.utcnow()
     for blog in blogs:
         blog["author"] = authors.get(blog["author_id"], {
             "id": blog["author_id"],
@@ -200,23 +202,21 @@ async def search_blogs(
             "avatar": "",
             "bio": ""
         })
-        blog["timestamp"] = format_timestamp(blog["created_at"])
+        blog["timestamp"] = format_timestamp(blog["created_at"], now)
     
-    return {
-        "blogs": convert_objectid_to_str(blogs),
+    return MongoJSONResponse({
+        "blogs": blogs,
         "total": total_count,
         "page": page,
         "per_page": per_page,
         "query": q
-    }
+    })
 
 # BLOG CATEGORY MANAGEMENT ENDPOINTS
 
 @router.get("/categories")
-async def get_blog_categories():
+async def get_blog_categories(db: AsyncDatabase = Depends(get_db)):
     """Get list of available blog categories"""
-    db = await get_database()
-    
     # Get all active blog categories from database
     blog_categories = await db.blog_categories.find({"is_active": True}).sort("name", 1).to_list(None)
     
@@ -231,10 +231,8 @@ async def get_blog_categories():
     return {"categories": categories}
 
 @router.get("/categories/detailed")
-async def get_detailed_blog_categories():
+async def get_detailed_blog_categories(db: AsyncDatabase = Depends(get_db)):
     """Get detailed blog category information with blog counts"""
-    db = await get_database()
-    
     # Get all active blog categories first
     categories = await db.blog_categories.find({"is_active": True}).sort("name", 1).to_list(None)
     
@@ -258,9 +256,10 @@ async def get_detailed_blog_categories():
     
     # Format response
     formatted_categories = []
+    now = datetime.utcnow()
     for cat in categories:
         try:
-            created_at_formatted = format_timestamp(cat["created_at"]) if cat.get("created_at") else "Unknown"
+            created_at_formatted = format_timestamp(cat["created_at"], now) if cat.get("created_at") else "Unknown"
         except:
             created_at_formatted = "Unknown"
             
@@ -280,11 +279,10 @@ async def get_detailed_blog_categories():
 async def add_custom_blog_category(
     category_name: str,
     description: Optional[str] = None,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Add a custom blog category"""
-    db = await get_database()
-    
     # Validate user exists
     user = await db.users.find_one({"_id": x_user_id})
     if not user and ObjectId.is_valid(x_user_id):
@@ -329,7 +327,14 @@ async def add_custom_blog_category(
         "blog_count": 0
     }
     
-    result = await db.blog_categories.insert_one(category_doc)
+    try:
+        result = await db.blog_categories.insert_one(category_doc)
+    except DuplicateKeyError:
+        # Another request created an active category with this name in the meantime
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Blog category already exists"
+        )
     
     return {
         "message": "Blog category added successfully",
@@ -342,10 +347,8 @@ async def add_custom_blog_category(
     }
 
 @router.get("/{blog_id}")
-async def get_blog_by_id(blog_id: str):
+async def get_blog_by_id(blog_id: str, db: AsyncDatabase = Depends(get_db)):
     """Get a specific blog by ID"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(blog_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -388,16 +391,15 @@ async def get_blog_by_id(blog_id: str):
     
     blog["timestamp"] = format_timestamp(blog["created_at"])
     
-    return convert_objectid_to_str(blog)
+    return MongoJSONResponse(blog)
 
 @router.post("")
 async def create_blog(
     blog_data: BlogCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Create a new blog (requires user ID from frontend Clerk authentication)"""
-    db = await get_database()
-    
     # Validate Clerk user ID format (should be a valid string identifier)
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -430,17 +432,16 @@ async def create_blog(
     result = await db.blogs.insert_one(blog_dict)
     
     # Return the created blog with author info
-    return await get_blog_by_id(str(result.inserted_id))
+    return await get_blog_by_id(str(result.inserted_id), db=db)
 
 @router.put("/{blog_id}")
 async def update_blog(
     blog_id: str,
     blog_update: BlogUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a blog (only by the author)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(blog_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -482,16 +483,15 @@ async def update_blog(
     )
     
     # Return updated blog
-    return await get_blog_by_id(blog_id)
+    return await get_blog_by_id(blog_id, db=db)
 
 @router.delete("/{blog_id}")
 async def delete_blog(
     blog_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Delete a blog (only by the author)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(blog_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -527,11 +527,10 @@ async def delete_blog(
 @router.post("/{blog_id}/upvote")
 async def toggle_blog_upvote(
     blog_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Toggle upvote on a blog"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(blog_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -613,25 +612,24 @@ async def seed_default_blog_categories(db):
     
     # Insert categories one by one to avoid duplicates
     for category in default_blog_categories:
-        # Check if category already exists
-        existing = await db.blog_categories.find_one({
+        # Upsert on the unique name so concurrently starting workers can't
+        # insert the same default category twice
+        category_doc = {
             "name": category,
-            "is_active": True
-        })
-        
-        if not existing:
-            category_doc = {
-                "name": category,
-                "slug": category.lower().replace(" ", "-").replace("&", "and"),
-                "description": f"Blogs focused on {category.lower()}",
-                "created_by": "system",
-                "created_at": datetime.utcnow(),
-                "is_active": True,
-                "is_default": True,
-                "blog_count": 0
-            }
-            
-            await db.blog_categories.insert_one(category_doc)
+            "slug": category.lower().replace(" ", "-").replace("&", "and"),
+            "description": f"Blogs focused on {category.lower()}",
+            "created_by": "system",
+            "created_at": datetime.utcnow(),
+            "is_active": True,
+            "is_default": True,
+            "blog_count": 0
+        }
+        result = await db.blog_categories.update_one(
+            {"name": category, "is_active": True},
+            {"$setOnInsert": category_doc},
+            upsert=True
+        )
+        if result.upserted_id is not None:
             added_count += 1
     
     if added_count > 0:
@@ -1,5 +1,5 @@
-from fastapi import APIRouter, HTTPException, status, Query, Header
-from app.database import get_database
+from fastapi import APIRouter, HTTPException, status, Query, Header, Depends
+from app.database import get_db
 from app.models.channel import (
     ChannelCreate, ChannelUpdate, ChannelResponse, ChannelListResponse, 
     ChannelType, ChannelMember
@@ -10,6 +10,7 @@ from app.utils.helpers import convert_objectid_to_str, format_timestamp
 from typing import Optional, List
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
 import secrets
 
 router = APIRouter()
@@ -19,11 +20,10 @@ async def get_community_channels(
     community_id: str,
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=50),
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get all channels in a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -70,6 +70,7 @@ async def get_community_channels(
     
     # Format timestamps and add additional info
     formatted_channels = []
+    now = datetime.utcnow()
     for channel in accessible_channels:
         # Get member count for this channel
         if channel.get("is_private", False):
@@ -91,10 +92,10 @@ async def get_community_channels(
             is_private=channel.get("is_private", False),
             community_id=community_id,
             created_by=channel["created_by"],
-            created_at=format_timestamp(channel["created_at"]),
-            updated_at=format_timestamp(channel.get("updated_at", channel["created_at"])),
+            created_at=format_timestamp(channel["created_at"], now),
+            updated_at=format_timestamp(channel.get("updated_at", channel["created_at"]), now),
             member_count=member_count,
-            last_message_at=format_timestamp(last_message["created_at"]) if last_message else None,
+            last_message_at=format_timestamp(last_message["created_at"], now) if last_message else None,
             allowed_users=channel.get("allowed_users", []) if channel.get("is_private", False) else []
         )
         formatted_channels.append(formatted_channel)
@@ -110,11 +111,10 @@ async def get_community_channels(
 async def create_channel(
     community_id: str,
     channel_data: ChannelCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Create a new channel in a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -182,11 +182,10 @@ async def update_channel(
     community_id: str,
     channel_id: str,
     channel_update: ChannelUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a channel (admin only)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id) or not ObjectId.is_valid(channel_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -262,11 +261,10 @@ async def update_channel(
 async def delete_channel(
     community_id: str,
     channel_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Delete a channel (admin only)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id) or not ObjectId.is_valid(channel_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -355,11 +353,10 @@ async def get_channel_messages(
     per_page: int = Query(20, ge=1, le=50),
     before: Optional[str] = Query(None, description="Get messages before this message ID"),
     after: Optional[str] = Query(None, description="Get messages after this message ID"),
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get messages in a specific channel"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -436,6 +433,7 @@ async def get_channel_messages(
     
     # Get author information for each message
     formatted_messages = []
+    now = datetime.utcnow()
     for message in messages:
         # Get author info
         author = await db.users.find_one({"_id": message["author_id"]})
@@ -462,10 +460,10 @@ async def get_channel_messages(
             channel_id=str(channel["_id"]),
             community_id=community_id,
             reply_to=message.get("reply_to"),
-            created_at=format_timestamp(message["created_at"]),
-            updated_at=format_timestamp(message.get("updated_at", message["created_at"])),
+            created_at=format_timestamp(message["created_at"], now),
+            updated_at=format_timestamp(message.get("updated_at", message["created_at"]), now),
             is_edited=message.get("is_edited", False),
-            edited_at=format_timestamp(message["edited_at"]) if message.get("edited_at") else None
+            edited_at=format_timestamp(message["edited_at"], now) if message.get("edited_at") else None
         )
         formatted_messages.append(formatted_message)
     
@@ -486,11 +484,10 @@ async def create_channel_message(
     community_id: str,
     channel_id: str,
     message_data: ChannelPostCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Send a message to a specific channel"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -607,11 +604,10 @@ async def send_typing_indicator(
     community_id: str,
     channel_id: str,
     typing_data: TypingUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Send typing indicator for a channel"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -698,11 +694,10 @@ async def send_typing_indicator(
 async def get_typing_indicators(
     community_id: str,
     channel_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get current typing indicators for a channel"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -760,12 +755,13 @@ async def get_typing_indicators(
     
     # Format response
     typing_users = []
+    now = datetime.utcnow()
     for indicator in typing_indicators:
         typing_user = TypingIndicator(
             user_id=indicator["user_id"],
             username=indicator["username"],
             avatar=indicator.get("avatar"),
-            started_at=format_timestamp(indicator["started_at"])
+            started_at=format_timestamp(indicator["started_at"], now)
         )
         typing_users.append(typing_user)
     
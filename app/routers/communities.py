@@ -1,27 +1,40 @@
-from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile
-from fastapi.responses import StreamingResponse
-from app.database import get_database
+from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile, Depends, Response
+from fastapi.sse import EventSourceResponse, ServerSentEvent
+from app.database import get_database, get_db
 from app.models.community import (
     CommunityCreate, CommunityUpdate, CommunityResponse, CommunitySettings,
     CommunityPostCreate, CommunityPostUpdate, CommunityPostResponse,
     ImageUploadResponse, CommunityInvite, SSEEvent, SSEEventType
 )
 from app.models.presence import CommunityPresenceResponse, PresenceResponse, PresenceStatus
-from app.utils.helpers import convert_objectid_to_str, format_timestamp, sanitize_html
+from app.utils.helpers import convert_objectid_to_str, format_timestamp, sanitize_html, ALLOWED_IMAGE_TYPES
+from app.utils.responses import MongoJSONResponse
 from typing import Optional, List
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 import secrets
 import os
 import shutil
-import json
 import asyncio
+from types import MappingProxyType
 from pathlib import Path
-import firebase_admin
-from firebase_admin import storage as fb_storage
+from app.storage.firebase import get_bucket
 
 router = APIRouter()
 
+# Community list sort options: order_by value -> (sort field, direction), read-only
+COMMUNITY_SORT_MAPPING = MappingProxyType({
+    "newest": ("created_at", -1),
+    "oldest": ("created_at", 1),
+    "most_members": ("member_count", -1),
+    "least_members": ("member_count", 1),
+    "alphabetical": ("name", 1),
+    "alphabetical_desc": ("name", -1)
+})
+
 # IMAGE UPLOAD ENDPOINTS
 
 @router.post("/upload/logo")
@@ -30,8 +43,7 @@ async def upload_community_logo(
     x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
 ):
     """Upload community logo image to Firebase Storage"""
-    allowed_types = ["image/jpeg", "image/png", "image/jpg", "image/webp"]
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only JPEG, PNG, JPG, and WebP images are allowed"
@@ -44,7 +56,7 @@ async def upload_community_logo(
             detail="File size must be less than 5MB"
         )
     # Upload to Firebase Storage
-    bucket = fb_storage.bucket()
+    bucket = get_bucket()
     file_extension = file.filename.split(".")[-1]
     unique_filename = f"community_logos/{secrets.token_hex(16)}.{file_extension}"
     blob = bucket.blob(unique_filename)
@@ -63,8 +75,7 @@ async def upload_community_cover(
     x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
 ):
     """Upload community cover image to Firebase Storage"""
-    allowed_types = ["image/jpeg", "image/png", "image/jpg", "image/webp"]
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only JPEG, PNG, JPG, and WebP images are allowed"
@@ -77,7 +88,7 @@ async def upload_community_cover(
             detail="File size must be less than 10MB"
         )
     # Upload to Firebase Storage
-    bucket = fb_storage.bucket()
+    bucket = get_bucket()
     file_extension = file.filename.split(".")[-1]
     unique_filename = f"community_covers/{secrets.token_hex(16)}.{file_extension}"
     blob = bucket.blob(unique_filename)
@@ -93,10 +104,8 @@ async def upload_community_cover(
 # CATEGORY MANAGEMENT ENDPOINTS
 
 @router.get("/categories")
-async def get_available_categories():
+async def get_available_categories(db: AsyncDatabase = Depends(get_db)):
     """Get list of available community categories from database"""
-    db = await get_database()
-    
     # Get all active categories from database
     categories_docs = await db.categories.find({"is_active": True}).sort("name", 1).to_list(None)
     
@@ -138,25 +147,24 @@ async def seed_default_categories(db):
     # Insert categories one by one to avoid duplicates
     added_count = 0
     for category in default_categories:
-        # Check if category already exists
-        existing = await db.categories.find_one({
+        # Upsert on the unique name so concurrently starting workers can't
+        # insert the same default category twice
+        category_doc = {
             "name": category,
-            "is_active": True
-        })
-        
-        if not existing:
-            category_doc = {
-                "name": category,
-                "slug": category.lower().replace(" ", "-"),
-                "description": f"Communities focused on {category.lower()}",
-                "created_by": "system",
-                "created_at": datetime.utcnow(),
-                "is_active": True,
-                "is_default": True,
-                "community_count": 0
-            }
-            
-            await db.categories.insert_one(category_doc)
+            "slug": category.lower().replace(" ", "-"),
+            "description": f"Communities focused on {category.lower()}",
+            "created_by": "system",
+            "created_at": datetime.utcnow(),
+            "is_active": True,
+            "is_default": True,
+            "community_count": 0
+        }
+        result = await db.categories.update_one(
+            {"name": category, "is_active": True},
+            {"$setOnInsert": category_doc},
+            upsert=True
+        )
+        if result.upserted_id is not None:
             added_count += 1
     
     print(f"✅ Seeded {added_count} new default categories")
@@ -174,18 +182,80 @@ async def update_category_counts(db, categories: List[str], increment: bool = Tr
         {"$inc": {"community_count": change}}
     )
 
+async def update_user_community_counts(db, user_ids: List[str], joined: int = 0, created: int = 0):
+    """Update the denormalized community counters on user documents"""
+    change = {}
+    if joined:
+        change["communities_count"] = joined
+    if created:
+        change["created_communities_count"] = created
+    if not user_ids or not change:
+        return
+    
+    # Members are stored as string IDs, but a user's _id may be an ObjectId
+    ids = list(user_ids) + [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+    await db.users.update_many(
+        {"_id": {"$in": ids}},
+        {"$inc": change}
+    )
+
+async def recompute_user_community_counts(db) -> int:
+    """Recompute the denormalized community counters on every user document
+
+    Each counted user gets both counters written with a single $set, and only users
+    that no longer belong to any community are zeroed, so readers never see a
+    blanket reset. Returns the number of users with communities.
+    """
+    joined_cursor, created_cursor = await asyncio.gather(
+        db.communities.aggregate([
+            {"$unwind": "$members"},
+            {"$group": {"_id": "$members", "count": {"$sum": 1}}}
+        ]),
+        db.communities.aggregate([
+            {"$group": {"_id": "$creator_id", "count": {"$sum": 1}}}
+        ])
+    )
+    counts = {}
+    for row in await joined_cursor.to_list(None):
+        if isinstance(row["_id"], str):
+            counts.setdefault(row["_id"], [0, 0])[0] = row["count"]
+    for row in await created_cursor.to_list(None):
+        if isinstance(row["_id"], str):
+            counts.setdefault(row["_id"], [0, 0])[1] = row["count"]
+    
+    # Members are stored as string IDs, but a user's _id may be an ObjectId
+    all_ids = []
+    updates = []
+    for user_id, (joined, created) in counts.items():
+        ids = [user_id, ObjectId(user_id)] if ObjectId.is_valid(user_id) else [user_id]
+        all_ids.extend(ids)
+        updates.append(UpdateOne(
+            {"_id": {"$in": ids}},
+            {"$set": {"communities_count": joined, "created_communities_count": created}}
+        ))
+    if updates:
+        await db.users.bulk_write(updates, ordered=False)
+    await db.users.update_many(
+        {
+            "_id": {"$nin": all_ids},
+            "$or": [{"communities_count": {"$ne": 0}}, {"created_communities_count": {"$ne": 0}}]
+        },
+        {"$set": {"communities_count": 0, "created_communities_count": 0}}
+    )
+    return len(counts)
+
 async def initialize_categories():
     """Initialize categories in database if they don't exist"""
     db = await get_database()
     
-    # Check if categories collection exists and has data
-    categories_count = await db.categories.count_documents({"is_active": True})
+    # Check if categories collection has data (one indexed probe instead of a count)
+    existing_category = await db.categories.find_one({"is_active": True}, {"_id": 1})
     
-    if categories_count == 0:
+    if not existing_category:
         await seed_default_categories(db)
         print("✅ Categories initialized successfully")
     else:
-        print(f"✅ Found {categories_count} existing categories")
+        print("✅ Found existing categories")
     
     return True
 
@@ -193,11 +263,10 @@ async def initialize_categories():
 async def add_custom_category(
     category_name: str,
     description: Optional[str] = None,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Add a custom category"""
-    db = await get_database()
-    
     # Validate user exists
     user = await db.users.find_one({"_id": x_user_id})
     if not user and ObjectId.is_valid(x_user_id):
@@ -242,7 +311,14 @@ async def add_custom_category(
         "community_count": 0
     }
     
-    result = await db.categories.insert_one(category_doc)
+    try:
+        result = await db.categories.insert_one(category_doc)
+    except DuplicateKeyError:
+        # Another request created an active category with this name in the meantime
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Category already exists"
+        )
     
     return {
         "message": "Category added successfully",
@@ -255,10 +331,8 @@ async def add_custom_category(
      }
 
 @router.get("/categories/detailed")
-async def get_detailed_categories():
+async def get_detailed_categories(db: AsyncDatabase = Depends(get_db)):
     """Get detailed category information with community counts"""
-    db = await get_database()
-    
     # Get all active categories first
     categories = await db.categories.find({"is_active": True}).sort("name", 1).to_list(None)
     
@@ -282,9 +356,10 @@ async def get_detailed_categories():
     
     # Format response
     formatted_categories = []
+    now = datetime.utcnow()
     for cat in categories:
         try:
-            created_at_formatted = format_timestamp(cat["created_at"]) if cat.get("created_at") else "Unknown"
+            created_at_formatted = format_timestamp(cat["created_at"], now) if cat.get("created_at") else "Unknown"
         except:
             created_at_formatted = "Unknown"
             
@@ -301,10 +376,8 @@ async def get_detailed_categories():
     return {"categories": formatted_categories}
 
 @router.get("/categories/{category_slug}")
-async def get_category_by_slug(category_slug: str):
+async def get_category_by_slug(category_slug: str, db: AsyncDatabase = Depends(get_db)):
     """Get a specific category by slug"""
-    db = await get_database()
-    
     category = await db.categories.find_one({"slug": category_slug, "is_active": True})
     if not category:
         raise HTTPException(
@@ -330,11 +403,10 @@ async def update_category(
     category_id: str,
     name: Optional[str] = None,
     description: Optional[str] = None,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a category (only by creator or admin)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(category_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -387,10 +459,17 @@ async def update_category(
     
     if update_data:
         update_data["updated_at"] = datetime.utcnow()
-        await db.categories.update_one(
-            {"_id": ObjectId(category_id)},
-            {"$set": update_data}
-        )
+        try:
+            await db.categories.update_one(
+                {"_id": ObjectId(category_id)},
+                {"$set": update_data}
+            )
+        except DuplicateKeyError:
+            # Another active category took this name after the check above
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Category name already exists"
+            )
     
     # Return updated category
     updated_category = await db.categories.find_one({"_id": ObjectId(category_id)})
@@ -409,11 +488,10 @@ async def update_category(
 @router.delete("/categories/{category_id}")
 async def delete_category(
     category_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Soft delete a category (only by creator or admin)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(category_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -453,11 +531,10 @@ async def delete_category(
 
 @router.post("/categories/recalculate-counts")
 async def recalculate_category_counts(
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Recalculate community counts for all categories (admin function)"""
-    db = await get_database()
-    
     # For now, anyone can run this. Later you can add admin role checks
     # Verify user exists
     user = await db.users.find_one({"_id": x_user_id})
@@ -495,11 +572,10 @@ async def recalculate_category_counts(
 
 @router.post("/categories/seed")
 async def manual_seed_categories(
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Manually seed categories (for testing/debugging)"""
-    db = await get_database()
-    
     # Verify user exists
     user = await db.users.find_one({"_id": x_user_id})
     if not user and ObjectId.is_valid(x_user_id):
@@ -534,11 +610,10 @@ async def get_communities(
     per_page: int = Query(10, ge=1, le=50),
     access_type: Optional[str] = Query(None),
     category: Optional[str] = Query(None),
-    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc")
+    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get all communities with pagination, filtering, and sorting"""
-    db = await get_database()
-    
     # Build filter
     filter_query = {}
     if access_type:
@@ -546,21 +621,11 @@ async def get_communities(
     if category:
         filter_query["categories"] = {"$in": [category]}
     
-    # Build sort criteria
-    sort_mapping = {
-        "newest": ("created_at", -1),
-        "oldest": ("created_at", 1),
-        "most_members": ("member_count", -1),
-        "least_members": ("member_count", 1),
-        "alphabetical": ("name", 1),
-        "alphabetical_desc": ("name", -1)
-    }
-    
     # Default to newest if invalid order_by provided
-    if order_by not in sort_mapping:
+    if order_by not in COMMUNITY_SORT_MAPPING:
         order_by = "newest"
     
-    sort_field, sort_direction = sort_mapping[order_by]
+    sort_field, sort_direction = COMMUNITY_SORT_MAPPING[order_by]
     
     skip = (page - 1) * per_page
     
@@ -573,22 +638,21 @@ async def get_communities(
     total_count = await db.communities.count_documents(filter_query)
     
     # Format timestamps
+    now = datetime.utcnow()
     for community in communities:
-        community["created_at"] = format_timestamp(community["created_at"])
+        community["created_at"] = format_timestamp(community["created_at"], now)
     
-    return {
-        "communities": convert_objectid_to_str(communities),
+    return MongoJSONResponse({
+        "communities": communities,
         "total": total_count,
         "page": page,
         "per_page": per_page,
         "order_by": order_by
-    }
+    })
 
 @router.get("/{community_id}")
-async def get_community_by_id(community_id: str):
+async def get_community_by_id(community_id: str, db: AsyncDatabase = Depends(get_db)):
     """Get a specific community by ID"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -605,16 +669,15 @@ async def get_community_by_id(community_id: str):
     
     community["created_at"] = format_timestamp(community["created_at"])
     
-    return convert_objectid_to_str(community)
+    return MongoJSONResponse(community)
 
 @router.post("")
 async def create_community(
     community_data: CommunityCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Create a new community with enhanced features"""
-    db = await get_database()
-    
     # Validate Clerk user ID format
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -670,18 +733,20 @@ async def create_community(
     if community_data.categories:
         await update_category_counts(db, community_data.categories, increment=True)
     
+    # The creator is also the first member
+    await update_user_community_counts(db, [x_user_id], joined=1, created=1)
+    
     # Get the created community
-    return await get_community_by_id(str(result.inserted_id))
+    return await get_community_by_id(str(result.inserted_id), db=db)
 
 @router.put("/{community_id}")
 async def update_community(
     community_id: str,
     community_update: CommunityUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a community (only by the creator)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -729,16 +794,15 @@ async def update_community(
     )
     
     # Return updated community
-    return await get_community_by_id(community_id)
+    return await get_community_by_id(community_id, db=db)
 
 @router.delete("/{community_id}")
 async def delete_community(
     community_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Delete a community (only by the creator)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -775,16 +839,18 @@ async def delete_community(
     await db.communities.delete_one({"_id": ObjectId(community_id)})
     await db.community_posts.delete_many({"community_id": community_id})
     
+    await update_user_community_counts(db, community.get("members", []), joined=-1)
+    await update_user_community_counts(db, [community["creator_id"]], created=-1)
+    
     return {"message": "Community deleted successfully"}
 
 @router.post("/{community_id}/join")
 async def join_community(
     community_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Join a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -823,25 +889,31 @@ async def join_community(
             detail="You are already a member of this community"
         )
     
-    # Add user to community
-    await db.communities.update_one(
-        {"_id": ObjectId(community_id)},
+    # Add user to community. The membership condition in the filter makes a
+    # concurrent duplicate join a no-op, so the counters are only bumped once.
+    result = await db.communities.update_one(
+        {"_id": ObjectId(community_id), "members": {"$ne": x_user_id}},
         {
             "$addToSet": {"members": x_user_id},
             "$inc": {"member_count": 1}
         }
     )
+    if result.modified_count != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You are already a member of this community"
+        )
+    await update_user_community_counts(db, [x_user_id], joined=1)
     
     return {"message": "Successfully joined the community"}
 
 @router.post("/{community_id}/leave")
 async def leave_community(
     community_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Leave a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -877,14 +949,21 @@ async def leave_community(
             detail="Community creator cannot leave. Transfer ownership or delete the community."
         )
     
-    # Remove user from community
-    await db.communities.update_one(
-        {"_id": ObjectId(community_id)},
+    # Remove user from community. The membership condition in the filter makes a
+    # concurrent duplicate leave a no-op, so the counters are only decremented once.
+    result = await db.communities.update_one(
+        {"_id": ObjectId(community_id), "members": x_user_id},
         {
             "$pull": {"members": x_user_id},
             "$inc": {"member_count": -1}
         }
     )
+    if result.modified_count != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You are not a member of this community"
+        )
+    await update_user_community_counts(db, [x_user_id], joined=-1)
     
     return {"message": "Successfully left the community"}
 
@@ -892,11 +971,10 @@ async def leave_community(
 async def get_community_members(
     community_id: str,
     page: int = Query(1, ge=1),
-    per_page: int = Query(20, ge=1, le=50)
+    per_page: int = Query(20, ge=1, le=50),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get community members"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -942,11 +1020,10 @@ async def get_community_posts(
     community_id: str,
     page: int = Query(1, ge=1),
     per_page: int = Query(10, ge=1, le=50),
-    post_type: Optional[str] = Query(None)
+    post_type: Optional[str] = Query(None),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get posts in a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -979,6 +1056,7 @@ async def get_community_posts(
     
     # Get author information for each post
     formatted_posts = []
+    now = datetime.utcnow()
     for post in posts:
         # Get author info
         author = await db.users.find_one({"_id": post["author_id"]})
@@ -1005,10 +1083,10 @@ async def get_community_posts(
             "community_id": post["community_id"],
             "channel_id": post.get("channel_id"),
             "reply_to": post.get("reply_to"),
-            "created_at": format_timestamp(post["created_at"]),
-            "updated_at": format_timestamp(post.get("updated_at", post["created_at"])),
+            "created_at": format_timestamp(post["created_at"], now),
+            "updated_at": format_timestamp(post.get("updated_at", post["created_at"]), now),
             "is_edited": post.get("is_edited", False),
-            "edited_at": format_timestamp(post["edited_at"]) if post.get("edited_at") else None,
+            "edited_at": format_timestamp(post["edited_at"], now) if post.get("edited_at") else None,
             "upvotes": post.get("upvotes", 0),
             "comments": post.get("comments", 0)
         }
@@ -1025,11 +1103,10 @@ async def get_community_posts(
 async def create_community_post(
     community_id: str,
     post_data: CommunityPostCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Create a new post in a community"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1102,11 +1179,10 @@ async def update_community_post(
     community_id: str,
     post_id: str,
     post_update: CommunityPostUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a community post (only by the author)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1173,11 +1249,10 @@ async def update_community_post(
 async def delete_community_post(
     community_id: str,
     post_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Delete a community post (only by the author)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1222,11 +1297,10 @@ async def delete_community_post(
 async def toggle_community_post_upvote(
     community_id: str,
     post_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Toggle upvote on a community post"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1305,11 +1379,10 @@ async def generate_invite_code(
     community_id: str,
     expires_in_hours: Optional[int] = Query(None, description="Hours until invite expires"),
     max_uses: Optional[int] = Query(None, description="Maximum number of uses"),
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Generate invite code for invite-only community (admin only)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1364,11 +1437,10 @@ async def generate_invite_code(
 @router.post("/join-by-invite")
 async def join_community_by_invite(
     invite_code: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Join a community using invite code"""
-    db = await get_database()
-    
     # Validate user ID
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -1423,14 +1495,20 @@ async def join_community_by_invite(
             detail="You are already a member of this community"
         )
     
-    # Add user to community
-    await db.communities.update_one(
-        {"_id": ObjectId(invite["community_id"])},
+    # Add user to community; a concurrent duplicate join is a no-op (see join_community)
+    result = await db.communities.update_one(
+        {"_id": ObjectId(invite["community_id"]), "members": {"$ne": x_user_id}},
         {
             "$addToSet": {"members": x_user_id},
             "$inc": {"member_count": 1}
         }
     )
+    if result.modified_count != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You are already a member of this community"
+        )
+    await update_user_community_counts(db, [x_user_id], joined=1)
     
     # Increment invite usage
     await db.community_invites.update_one(
@@ -1450,11 +1528,10 @@ async def join_community_by_invite(
 @router.get("/{community_id}/invites")
 async def list_community_invites(
     community_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """List all active invites for a community (admin only)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1483,11 +1560,12 @@ async def list_community_invites(
     
     # Format response
     formatted_invites = []
+    now = datetime.utcnow()
     for invite in invites:
         formatted_invites.append({
             "invite_code": invite["invite_code"],
-            "created_at": format_timestamp(invite["created_at"]),
-            "expires_at": format_timestamp(invite["expires_at"]) if invite.get("expires_at") else None,
+            "created_at": format_timestamp(invite["created_at"], now),
+            "expires_at": format_timestamp(invite["expires_at"], now) if invite.get("expires_at") else None,
             "max_uses": invite.get("max_uses"),
             "current_uses": invite["current_uses"],
             "created_by": invite["created_by"]
@@ -1499,11 +1577,10 @@ async def list_community_invites(
 async def deactivate_invite(
     community_id: str,
     invite_code: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Deactivate an invite code (admin only)"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -1540,240 +1617,254 @@ async def deactivate_invite(
 
 # REAL-TIME COMMUNICATION ENDPOINTS
 
-@router.get("/{community_id}/posts/stream")
-async def stream_community_updates(
+async def _get_stream_community(
     community_id: str,
-    channel_id: Optional[str] = Query(None, description="Filter by specific channel"),
-    after: Optional[str] = Query(None, description="Get events after this message ID"),
-    x_user_id: Optional[str] = Header(None, description="User ID from Clerk (frontend)")
+    response: Response,
+    x_user_id: Optional[str] = Header(None, description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
-    """Server-Sent Events stream for real-time community updates"""
-    
+    """Validate stream access before the event stream is opened"""
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid community ID"
         )
-    
+
     # Validate user access
-    db = await get_database()
     community = await db.communities.find_one({"_id": ObjectId(community_id)})
     if not community:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Community not found"
         )
-    
+
     # If user ID is provided, check membership
     if x_user_id and x_user_id not in community.get("members", []):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You must be a member to receive updates"
         )
-    
-    async def event_generator():
-        """Generate SSE events"""
-        last_check = datetime.utcnow()
-        current_community = community  # Initialize community reference for the generator
-        
-        # Send initial connection event
-        connection_event = SSEEvent(
-            type=SSEEventType.MESSAGE,
-            data={"status": "connected", "message": "Connected to community stream"},
-            community_id=community_id,
-            channel_id=channel_id,
-            timestamp=format_timestamp(datetime.utcnow())
-        )
-        yield f"data: {json.dumps(connection_event.dict())}\n\n"
-        
-        while True:
-            try:
-                # Check for new messages
-                filter_query = {
-                    "community_id": community_id,
-                    "created_at": {"$gt": last_check}
-                }
-                
-                if channel_id:
-                    filter_query["channel_id"] = channel_id
-                
-                if after and ObjectId.is_valid(after):
-                    filter_query["_id"] = {"$gt": ObjectId(after)}
-                
-                # Get new messages
-                new_messages = await db.posts.find(filter_query)\
-                    .sort("created_at", 1)\
-                    .to_list(50)  # Limit to 50 messages per check
-                
-                for message in new_messages:
-                    # Get author info
-                    author = await db.users.find_one({"_id": message["author_id"]})
-                    if author:
-                        author_info = {
-                            "id": str(author["_id"]),
-                            "name": author["name"],
-                            "username": author.get("username", ""),
-                            "avatar": author.get("avatar", "")
-                        }
-                    else:
-                        author_info = {
-                            "id": message["author_id"],
-                            "name": "Unknown User",
-                            "username": "unknown",
-                            "avatar": ""
-                        }
-                    
-                    # Create message event
-                    message_data = {
-                        "id": str(message["_id"]),
-                        "content": message["content"],
-                        "author": author_info,
-                        "type": message["type"],
-                        "channel_id": message.get("channel_id"),
-                        "community_id": community_id,
-                        "reply_to": message.get("reply_to"),
-                        "created_at": format_timestamp(message["created_at"]),
-                        "updated_at": format_timestamp(message.get("updated_at", message["created_at"])),
-                        "is_edited": message.get("is_edited", False),
-                        "edited_at": format_timestamp(message["edited_at"]) if message.get("edited_at") else None
+
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Headers"] = "*"
+    return community
+
+@router.get("/{community_id}/posts/stream", response_class=EventSourceResponse)
+async def stream_community_updates(
+    community_id: str,
+    channel_id: Optional[str] = Query(None, description="Filter by specific channel"),
+    after: Optional[str] = Query(None, description="Get events after this message ID"),
+    community: dict = Depends(_get_stream_community),
+    db: AsyncDatabase = Depends(get_db)
+):
+    """Server-Sent Events stream for real-time community updates"""
+    last_check = datetime.utcnow()
+    current_community = community
+
+    # Send initial connection event
+    connection_event = SSEEvent(
+        type=SSEEventType.MESSAGE,
+        data={"status": "connected", "message": "Connected to community stream"},
+        community_id=community_id,
+        channel_id=channel_id,
+        timestamp=format_timestamp(datetime.utcnow())
+    )
+    yield ServerSentEvent(data=connection_event)
+
+    while True:
+        try:
+            # Format the tick's timestamp once and reuse it for every event below
+            now_ts = format_timestamp(datetime.utcnow())
+
+            # Check for new messages
+            filter_query = {
+                "community_id": community_id,
+                "created_at": {"$gt": last_check}
+            }
+
+            if channel_id:
+                filter_query["channel_id"] = channel_id
+
+            if after and ObjectId.is_valid(after):
+                filter_query["_id"] = {"$gt": ObjectId(after)}
+
+            # Get new messages
+            new_messages = await db.posts.find(filter_query)\
+                .sort("created_at", 1)\
+                .to_list(50)  # Limit to 50 messages per check
+
+            for message in new_messages:
+                # Get author info
+                author = await db.users.find_one({"_id": message["author_id"]})
+                if author:
+                    author_info = {
+                        "id": str(author["_id"]),
+                        "name": author["name"],
+                        "username": author.get("username", ""),
+                        "avatar": author.get("avatar", "")
                     }
-                    
-                    message_event = SSEEvent(
-                        type=SSEEventType.MESSAGE,
-                        data=message_data,
-                        community_id=community_id,
-                        channel_id=message.get("channel_id"),
-                        timestamp=format_timestamp(message["created_at"])
-                    )
-                    
-                    yield f"data: {json.dumps(message_event.dict())}\n\n"
-                
-                # Check for presence updates
-                presence_updates = await db.user_presence.find({
-                    "user_id": {"$in": current_community.get("members", [])},
-                    "updated_at": {"$gt": last_check}
-                }).to_list(None)
-                
-                for presence in presence_updates:
-                    presence_data = {
-                        "user_id": presence["user_id"],
-                        "status": presence["status"],
-                        "custom_message": presence.get("custom_message"),
-                        "last_seen": format_timestamp(presence["last_seen"]),
-                        "updated_at": format_timestamp(presence["updated_at"])
+                else:
+                    author_info = {
+                        "id": message["author_id"],
+                        "name": "Unknown User",
+                        "username": "unknown",
+                        "avatar": ""
                     }
-                    
-                    presence_event = SSEEvent(
-                        type=SSEEventType.PRESENCE,
-                        data=presence_data,
-                        community_id=community_id,
-                        channel_id=None,
-                        timestamp=format_timestamp(presence["updated_at"])
-                    )
-                    
-                    yield f"data: {json.dumps(presence_event.dict())}\n\n"
-                
-                # Check for new members
-                updated_community = await db.communities.find_one({"_id": ObjectId(community_id)})
-                current_members = set(updated_community.get("members", []))
-                previous_members = set(current_community.get("members", []))
-                
-                new_members = current_members - previous_members
-                left_members = previous_members - current_members
-                
-                for new_member_id in new_members:
-                    user = await db.users.find_one({"_id": new_member_id})
-                    if user:
-                        join_data = {
-                            "user_id": new_member_id,
-                            "name": user["name"],
-                            "username": user.get("username", ""),
-                            "avatar": user.get("avatar", "")
-                        }
-                        
-                        join_event = SSEEvent(
-                            type=SSEEventType.USER_JOIN,
-                            data=join_data,
-                            community_id=community_id,
-                            channel_id=None,
-                            timestamp=format_timestamp(datetime.utcnow())
-                        )
-                        
-                        yield f"data: {json.dumps(join_event.dict())}\n\n"
-                
-                for left_member_id in left_members:
-                    leave_data = {
-                        "user_id": left_member_id
+
+                # Create message event
+                message_data = {
+                    "id": str(message["_id"]),
+                    "content": message["content"],
+                    "author": author_info,
+                    "type": message["type"],
+                    "channel_id": message.get("channel_id"),
+                    "community_id": community_id,
+                    "reply_to": message.get("reply_to"),
+                    "created_at": format_timestamp(message["created_at"]),
+                    "updated_at": format_timestamp(message.get("updated_at", message["created_at"])),
+                    "is_edited": message.get("is_edited", False),
+                    "edited_at": format_timestamp(message["edited_at"]) if message.get("edited_at") else None
+                }
+
+                message_event = SSEEvent(
+                    type=SSEEventType.MESSAGE,
+                    data=message_data,
+                    community_id=community_id,
+                    channel_id=message.get("channel_id"),
+                    timestamp=format_timestamp(message["created_at"])
+                )
+
+                yield ServerSentEvent(data=message_event)
+
+            # Check for presence updates
+            presence_updates = await db.user_presence.find({
+                "user_id": {"$in": current_community.get("members", [])},
+                "updated_at": {"$gt": last_check}
+            }).to_list(None)
+
+            for presence in presence_updates:
+                presence_data = {
+                    "user_id": presence["user_id"],
+                    "status": presence["status"],
+                    "custom_message": presence.get("custom_message"),
+                    "last_seen": format_timestamp(presence["last_seen"]),
+                    "updated_at": format_timestamp(presence["updated_at"])
+                }
+
+                presence_event = SSEEvent(
+                    type=SSEEventType.PRESENCE,
+                    data=presence_data,
+                    community_id=community_id,
+                    channel_id=None,
+                    timestamp=format_timestamp(presence["updated_at"])
+                )
+
+                yield ServerSentEvent(data=presence_event)
+
+            # Check for new members
+            updated_community = await db.communities.find_one({"_id": ObjectId(community_id)})
+            current_members = set(updated_community.get("members", []))
+            previous_members = set(current_community.get("members", []))
+
+            new_members = current_members - previous_members
+            left_members = previous_members - current_members
+
+            for new_member_id in new_members:
+                user = await db.users.find_one({"_id": new_member_id})
+                if user:
+                    join_data = {
+                        "user_id": new_member_id,
+                        "name": user["name"],
+                        "username": user.get("username", ""),
+                        "avatar": user.get("avatar", "")
                     }
-                    
-                    leave_event = SSEEvent(
-                        type=SSEEventType.USER_LEAVE,
-                        data=leave_data,
+
+                    join_event = SSEEvent(
+                        type=SSEEventType.USER_JOIN,
+                        data=join_data,
                         community_id=community_id,
                         channel_id=None,
-                        timestamp=format_timestamp(datetime.utcnow())
+                        timestamp=now_ts
                     )
-                    
-                    yield f"data: {json.dumps(leave_event.dict())}\n\n"
-                
-                # Update community reference and last check time
-                current_community = updated_community
-                last_check = datetime.utcnow()
-                
-                # Send heartbeat every 30 seconds
-                heartbeat_event = SSEEvent(
-                    type="heartbeat",
-                    data={"timestamp": format_timestamp(datetime.utcnow())},
-                    community_id=community_id,
-                    channel_id=None,
-                    timestamp=format_timestamp(datetime.utcnow())
-                )
-                yield f"data: {json.dumps(heartbeat_event.dict())}\n\n"
-                
-                # Wait before next check
-                await asyncio.sleep(2)  # Check every 2 seconds
-                
-            except Exception as e:
-                # Send error event and break
-                error_event = SSEEvent(
-                    type="error",
-                    data={"error": str(e), "message": "Stream error occurred"},
+
+                    yield ServerSentEvent(data=join_event)
+
+            for left_member_id in left_members:
+                leave_data = {
+                    "user_id": left_member_id
+                }
+
+                leave_event = SSEEvent(
+                    type=SSEEventType.USER_LEAVE,
+                    data=leave_data,
                     community_id=community_id,
                     channel_id=None,
-                    timestamp=format_timestamp(datetime.utcnow())
+                    timestamp=now_ts
                 )
-                yield f"data: {json.dumps(error_event.dict())}\n\n"
-                break
-    
-    return StreamingResponse(
-        event_generator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "*"
-        }
-    )
+
+                yield ServerSentEvent(data=leave_event)
+
+            # Update community reference and last check time
+            current_community = updated_community
+            last_check = datetime.utcnow()
+
+            # Send an application-level heartbeat after every poll (every 2 seconds);
+            # idle connections are also kept open by FastAPI's own SSE keep-alive pings
+            heartbeat_event = SSEEvent(
+                type="heartbeat",
+                data={"timestamp": now_ts},
+                community_id=community_id,
+                channel_id=None,
+                timestamp=now_ts
+            )
+            yield ServerSentEvent(data=heartbeat_event)
+
+            # Wait before next check
+            await asyncio.sleep(2)  # Check every 2 seconds
+
+        except Exception as e:
+            # Send error event and break
+            error_event = SSEEvent(
+                type="error",
+                data={"error": str(e), "message": "Stream error occurred"},
+                community_id=community_id,
+                channel_id=None,
+                timestamp=format_timestamp(datetime.utcnow())
+            )
+            yield ServerSentEvent(data=error_event)
+            break
 
 # PRESENCE ENDPOINTS
 
 @router.get("/{community_id}/presence")
 async def get_community_presence(
     community_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get presence status for all community members"""
-    db = await get_database()
-    
     if not ObjectId.is_valid(community_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid community ID"
         )
     
+    # Fetch the member list and join their presence records server-side
+    # (uses the user_presence.user_id index for the lookup)
+    cursor = await db.communities.aggregate([
+        {"$match": {"_id": ObjectId(community_id)}},
+        {"$project": {"members": {"$ifNull": ["$members", []]}}},
+        {"$lookup": {
+            "from": "user_presence",
+            "localField": "members",
+            "foreignField": "user_id",
+            "as": "presences"
+        }}
+    ])
+    result = await cursor.to_list(1)
+    
     # Check if community exists and user is a member
-    community = await db.communities.find_one({"_id": ObjectId(community_id)})
+    community = result[0] if result else None
     if not community:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -1786,16 +1877,15 @@ async def get_community_presence(
             detail="You must be a member to view community presence"
         )
     
-    # Get all member user IDs
+    # Get all member user IDs and their presence data
     member_ids = community.get("members", [])
-    
-    # Get presence data for all members
-    presences = await db.user_presence.find({"user_id": {"$in": member_ids}}).to_list(None)
+    presences = community["presences"]
     
     # Create presence map
     presence_map = {}
     online_count = 0
     
+    now = datetime.utcnow()
     for presence in presences:
         user_id = presence["user_id"]
         status = presence["status"]
@@ -1807,8 +1897,8 @@ async def get_community_presence(
             user_id=user_id,
             status=status,
             custom_message=presence.get("custom_message"),
-            last_seen=format_timestamp(presence["last_seen"]),
-            updated_at=format_timestamp(presence["updated_at"])
+            last_seen=format_timestamp(presence["last_seen"], now),
+            updated_at=format_timestamp(presence["updated_at"], now)
         )
     
     # For members without presence records, set them as offline
@@ -1818,8 +1908,8 @@ async def get_community_presence(
                 user_id=member_id,
                 status=PresenceStatus.OFFLINE,
                 custom_message=None,
-                last_seen=format_timestamp(datetime.utcnow()),
-                updated_at=format_timestamp(datetime.utcnow())
+                last_seen=format_timestamp(now, now),
+                updated_at=format_timestamp(now, now)
             )
     
     return CommunityPresenceResponse(
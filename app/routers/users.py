@@ -1,31 +1,176 @@
-from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile
-from app.database import get_database
+from fastapi import APIRouter, HTTPException, status, Query, Header, File, UploadFile, Depends
+from app.database import get_db, CASE_INSENSITIVE_COLLATION
 from app.models.user import UserCreate, UserUpdate, User
 from app.models.presence import PresenceUpdate, PresenceResponse, CommunityPresenceResponse, PresenceStatus
-from app.utils.helpers import convert_objectid_to_str, format_timestamp
+from app.utils.helpers import convert_objectid_to_str, format_timestamp, encode_cursor, decode_cursor, ALLOWED_IMAGE_TYPES
+from app.utils.responses import MongoJSONResponse
+from app.routers.communities import COMMUNITY_SORT_MAPPING
 from typing import Optional, List
 from datetime import datetime
 from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import secrets
-from firebase_admin import storage as fb_storage
+import asyncio
+from collections import Counter
+from cachetools import TTLCache
+from app.storage.firebase import get_bucket
 
 router = APIRouter()
 
+# Upper bound for the optional total counts on paginated endpoints
+MAX_COUNT = 10000
+
+# 5MB limit for avatars (also enforced on the raw request body by the
+# UploadSizeLimitMiddleware registered in app.app_factory.create_app)
+MAX_AVATAR_SIZE = 5 * 1024 * 1024
+
+# Projections for list responses, so only the fields they show come over the wire.
+# Community lists rely on the stored member_count rather than shipping the members array,
+# and blog lists show the excerpt rather than the full content.
+USER_LIST_PROJECTION = {"name": 1, "username": 1, "avatar": 1, "bio": 1, "created_at": 1}
+BLOG_LIST_PROJECTION = {"content": 0, "upvoted_by": 0}
+COMMUNITY_LIST_PROJECTION = {"members": 0}
+
+def _user_id_query(user_id: str) -> dict:
+    """Build a query matching a user stored under a Clerk string ID or an ObjectId"""
+    ids = [user_id]
+    if ObjectId.is_valid(user_id):
+        ids.append(ObjectId(user_id))
+    return {"_id": {"$in": ids}}
+
+# Process-local map from a requested user ID to the stored user's _id (as a string).
+# The mapping never changes while the account exists, so handlers that only need the
+# ID can skip the database; delete_user evicts it, and the TTL bounds staleness across workers.
+_USER_ID_CACHE = TTLCache(maxsize=10000, ttl=300)
+
+# Error details for the unique user fields, keyed by field name
+USER_CONFLICT_DETAILS = {
+    "_id": "User already exists",
+    "email": "User with this email already exists",
+    "username": "Username already exists"
+}
+
+USER_UPDATE_CONFLICT_DETAILS = {
+    "email": "Email already exists",
+    "username": "Username already exists"
+}
+
+def _duplicate_key_detail(error: DuplicateKeyError, details: dict = USER_CONFLICT_DETAILS) -> str:
+    """Map a duplicate key error on users to the matching error detail"""
+    key_pattern = (error.details or {}).get("keyPattern", {})
+    for field, detail in details.items():
+        if field in key_pattern:
+            return detail
+    return "User already exists"
+
+async def _find_user(db, user_id: str):
+    """Find a user by Clerk string ID or ObjectId in a single round trip"""
+    user = await db.users.find_one(_user_id_query(user_id))
+    if user:
+        _USER_ID_CACHE[user_id] = str(user["_id"])
+    return user
+
+async def _resolve_user_id(db, user_id: str) -> Optional[str]:
+    """Resolve a user ID to the stored user's ID, or None if there is no such user"""
+    actual_user_id = _USER_ID_CACHE.get(user_id)
+    if actual_user_id is None:
+        user = await db.users.find_one(_user_id_query(user_id), {"_id": 1})
+        if not user:
+            return None
+        actual_user_id = _USER_ID_CACHE[user_id] = str(user["_id"])
+    return actual_user_id
+
+def _keyset_filter(after: str, sort_field: str, sort_direction: int) -> dict:
+    """Build the range filter selecting documents that sort after the given cursor"""
+    try:
+        cursor = decode_cursor(after)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+    
+    op = "$lt" if sort_direction < 0 else "$gt"
+    return {
+        "$or": [
+            {sort_field: {op: cursor["v"]}},
+            {sort_field: cursor["v"], "_id": {op: cursor["id"]}}
+        ]
+    }
+
+def _membership_filter(user_id: str, membership_type: Optional[str]) -> dict:
+    """Build the community filter for a user's created, joined or all communities"""
+    if membership_type == "created":
+        return {"creator_id": user_id}
+    elif membership_type == "joined":
+        return {"members": user_id, "creator_id": {"$ne": user_id}}
+    else:  # "all" or None
+        return {"members": user_id}
+
+async def _aggregate_to_list(collection, pipeline: list, length: Optional[int] = None) -> list:
+    """Run an aggregation pipeline and collect its results"""
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(length)
+
+async def _find_page(
+    collection,
+    filter_query: dict,
+    sort_field: str,
+    sort_direction: int,
+    page: int,
+    per_page: int,
+    after: Optional[str] = None,
+    include_total: bool = False,
+    collation: Optional[dict] = None,
+    projection: Optional[dict] = None
+):
+    """Fetch one page of documents along with the next page's cursor
+    
+    Pages are addressed by the opaque ``after`` cursor (keyset pagination), which
+    turns into an index range scan. ``page`` is only used as a skip-based fallback
+    for clients that don't send a cursor. The total match count is only computed
+    when ``include_total`` is set, and is capped at MAX_COUNT for filtered queries.
+    """
+    sort = [(sort_field, sort_direction), ("_id", sort_direction)]
+    limit = per_page + 1  # One extra document tells us whether there is a next page
+    
+    if after:
+        range_filter = _keyset_filter(after, sort_field, sort_direction)
+        cursor = collection.find({"$and": [filter_query, range_filter]}, projection).sort(sort)
+    else:
+        cursor = collection.find(filter_query, projection).sort(sort).skip((page - 1) * per_page)
+    page_query = cursor.collation(collation).limit(limit).to_list(limit)
+    
+    total = None
+    if include_total:
+        if filter_query:
+            count_query = collection.count_documents(filter_query, limit=MAX_COUNT, collation=collation)
+        else:
+            # Unfiltered listing: read the count from collection metadata
+            count_query = collection.estimated_document_count()
+        items, total = await asyncio.gather(page_query, count_query)
+    else:
+        items = await page_query
+    
+    next_cursor = encode_cursor(items[per_page - 1], sort_field) if len(items) > per_page else None
+    return items[:per_page], total, next_cursor
+
 # MISSING ENDPOINTS FOR FRONTEND
 
 @router.get("/{user_id}/communities")
 async def get_user_communities(
     user_id: str,
     page: int = Query(1, ge=1),
-    per_page: int = Query(50, ge=1, le=100)
+    per_page: int = Query(50, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor (takes precedence over page)"),
+    include_total: bool = Query(False, description="Also return the total number of matches (capped at 10000)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get communities for a specific user (used by frontend)"""
-    db = await get_database()
-    
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -33,70 +178,75 @@ async def get_user_communities(
             detail="User not found"
         )
     
-    skip = (page - 1) * per_page
-    
     # Get communities where user is a member
-    communities = await db.communities.find({"members": user_id})\
-        .sort("created_at", -1)\
-        .skip(skip)\
-        .limit(per_page)\
-        .to_list(per_page)
-    
-    total_count = await db.communities.count_documents({"members": user_id})
+    communities, total_count, next_cursor = await _find_page(
+        db.communities, {"members": user_id}, "created_at", -1, page, per_page, after, include_total,
+        projection=COMMUNITY_LIST_PROJECTION
+    )
     
     # Format timestamps
+    now = datetime.utcnow()
     for community in communities:
-        community["created_at"] = format_timestamp(community["created_at"])
+        community["created_at"] = format_timestamp(community["created_at"], now)
     
-    return {
-        "communities": convert_objectid_to_str(communities),
+    return MongoJSONResponse({
+        "communities": communities,
         "total": total_count,
         "page": page,
-        "per_page": per_page
-    }
+        "per_page": per_page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None
+    })
 
 # USER AVATAR UPLOAD ENDPOINT
 
+def _upload_avatar_sync(fileobj, filename: str, size: int, content_type: str) -> str:
+    """Stream an avatar to Firebase Storage and return its public URL"""
+    blob = get_bucket().blob(filename)
+    # Stream the spooled upload to Storage rather than buffering it as bytes
+    blob.upload_from_file(fileobj, rewind=True, size=size, content_type=content_type)
+    blob.make_public()
+    return blob.public_url
+
 @router.post("/upload/avatar")
 async def upload_user_avatar(
     file: UploadFile = File(...),
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Upload user avatar image to Firebase Storage"""
-    allowed_types = ["image/jpeg", "image/png", "image/jpg", "image/webp"]
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Only JPEG, PNG, JPG, and WebP images are allowed"
         )
     
-    content = await file.read()
-    file_size = len(content)
-    if file_size > 5 * 1024 * 1024:  # 5MB limit for avatars
+    # Check the size without reading the upload into memory
+    file_size = file.size
+    if file_size is None:
+        file.file.seek(0, 2)
+        file_size = file.file.tell()
+        file.file.seek(0)
+    if file_size > MAX_AVATAR_SIZE:
+        # Same status the upload size middleware uses for larger bodies
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
             detail="File size must be less than 5MB"
         )
     
     # Verify user exists
-    db = await get_database()
-    user = await db.users.find_one({"_id": x_user_id})
-    if not user and ObjectId.is_valid(x_user_id):
-        user = await db.users.find_one({"_id": ObjectId(x_user_id)})
-    if not user:
+    if not await _resolve_user_id(db, x_user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    # Upload to Firebase Storage
-    bucket = fb_storage.bucket()
+    # Upload to Firebase Storage off the event loop (the SDK is blocking)
     file_extension = file.filename.split(".")[-1]
     unique_filename = f"user_avatars/{secrets.token_hex(16)}.{file_extension}"
-    blob = bucket.blob(unique_filename)
-    blob.upload_from_string(content, content_type=file.content_type)
-    blob.make_public()
-    file_url = blob.public_url
+    file_url = await asyncio.to_thread(
+        _upload_avatar_sync, file.file, unique_filename, file_size, file.content_type
+    )
     
     return {
         "url": file_url,
@@ -108,49 +258,53 @@ async def upload_user_avatar(
 async def get_users(
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=50),
-    search: Optional[str] = Query(None)
+    search: Optional[str] = Query(None),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor (takes precedence over page)"),
+    include_total: bool = Query(False, description="Also return the total number of matches (capped at 10000)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get all users with pagination and optional search"""
-    db = await get_database()
-    
     # Build filter
     filter_query = {}
     if search:
+        # Case-insensitive prefix match. $regex ignores collations, so use a range
+        # query instead: under the collation it is served by the *_ci indexes, and
+        # U+FFFF sorts after every other character.
+        prefix_range = {"$gte": search, "$lt": search + "\uffff"}
         filter_query = {
             "$or": [
-                {"name": {"$regex": search, "$options": "i"}},
-                {"username": {"$regex": search, "$options": "i"}},
-                {"email": {"$regex": search, "$options": "i"}}
+                {"name": prefix_range},
+                {"username": prefix_range},
+                {"email": prefix_range}
             ]
         }
     
-    skip = (page - 1) * per_page
-    
-    users = await db.users.find(filter_query)\
-        .sort("created_at", -1)\
-        .skip(skip)\
-        .limit(per_page)\
-        .to_list(per_page)
-    
-    total_count = await db.users.count_documents(filter_query)
+    users, total_count, next_cursor = await _find_page(
+        db.users, filter_query, "created_at", -1, page, per_page, after, include_total,
+        collation=CASE_INSENSITIVE_COLLATION if search else None,
+        # Sensitive fields such as email are left out of the public listing
+        projection=USER_LIST_PROJECTION
+    )
     
-    # Format timestamps and exclude sensitive fields
+    # Format timestamps
+    now = datetime.utcnow()
     for user in users:
-        user["created_at"] = format_timestamp(user["created_at"])
-        # Remove sensitive fields from public listing
-        user.pop("email", None)
+        user["created_at"] = format_timestamp(user["created_at"], now)
     
-    return {
-        "users": convert_objectid_to_str(users),
+    return MongoJSONResponse({
+        "users": users,
         "total": total_count,
         "page": page,
-        "per_page": per_page
-          }
+        "per_page": per_page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None
+    })
 
 
 @router.get("/me/profile")
 async def get_my_profile(
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get current user's profile data using authentication header (same as /profile)"""
     # Validate Clerk user ID from header
@@ -160,8 +314,7 @@ async def get_my_profile(
             detail="Invalid user ID from header"
         )
     
-    db = await get_database()
-    return await _get_profile_data(x_user_id, db)
+    return MongoJSONResponse(await _get_profile_data(x_user_id, db))
 
 @router.get("/me/communities")
 async def get_my_communities(
@@ -169,7 +322,10 @@ async def get_my_communities(
     page: int = Query(1, ge=1),
     per_page: int = Query(20, ge=1, le=50),
     membership_type: Optional[str] = Query("joined", regex="^(created|joined|all)$"),
-    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc")
+    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc"),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor (takes precedence over page)"),
+    include_total: bool = Query(False, description="Also return the total number of matches (capped at 10000)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get current user's communities (joined by default) with sorting options"""
     # Validate Clerk user ID from header
@@ -179,12 +335,8 @@ async def get_my_communities(
             detail="Invalid user ID from header"
         )
     
-    db = await get_database()
-    
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": x_user_id})
-    if not user and ObjectId.is_valid(x_user_id):
-        user = await db.users.find_one({"_id": ObjectId(x_user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, x_user_id)
     
     if not user:
         raise HTTPException(
@@ -192,56 +344,35 @@ async def get_my_communities(
             detail="User not found"
         )
     
-    skip = (page - 1) * per_page
-    
     # Use the actual user ID from database for queries
     actual_user_id = str(user["_id"])
     
-    # Build filter based on membership type
-    if membership_type == "created":
-        filter_query = {"creator_id": actual_user_id}
-    elif membership_type == "joined":
-        filter_query = {"members": actual_user_id, "creator_id": {"$ne": actual_user_id}}
-    else:  # "all"
-        filter_query = {"members": actual_user_id}
-    
-    # Build sort criteria
-    sort_mapping = {
-        "newest": ("created_at", -1),
-        "oldest": ("created_at", 1),
-        "most_members": ("member_count", -1),
-        "least_members": ("member_count", 1),
-        "alphabetical": ("name", 1),
-        "alphabetical_desc": ("name", -1)
-    }
+    filter_query = _membership_filter(actual_user_id, membership_type)
     
     # Default to newest if invalid order_by provided
-    if order_by not in sort_mapping:
+    if order_by not in COMMUNITY_SORT_MAPPING:
         order_by = "newest"
     
-    sort_field, sort_direction = sort_mapping[order_by]
-    
-    communities = await db.communities.find(filter_query)\
-        .sort(sort_field, sort_direction)\
-        .skip(skip)\
-        .limit(per_page)\
-        .to_list(per_page)
+    sort_field, sort_direction = COMMUNITY_SORT_MAPPING[order_by]
     
-    total_count = await db.communities.count_documents(filter_query)
+    communities, total_count, next_cursor = await _find_page(
+        db.communities, filter_query, sort_field, sort_direction, page, per_page, after, include_total,
+        projection=COMMUNITY_LIST_PROJECTION
+    )
     
     # Add user's role in each community and format timestamps
+    now = datetime.utcnow()
     for community in communities:
         community["user_role"] = "admin" if community["creator_id"] == actual_user_id else "member"
-        community["created_at"] = format_timestamp(community["created_at"])
-        
-        # Add member count
-        community["member_count"] = len(community.get("members", []))
+        community["created_at"] = format_timestamp(community["created_at"], now)
     
-    return {
-        "communities": convert_objectid_to_str(communities),
+    return MongoJSONResponse({
+        "communities": communities,
         "total": total_count,
         "page": page,
         "per_page": per_page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
         "user": {
             "id": actual_user_id,
             "name": user["name"],
@@ -249,11 +380,12 @@ async def get_my_communities(
         },
         "membership_type": membership_type,
         "order_by": order_by
-    }
+    })
 
 @router.get("/profile")
 async def get_user_profile(
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get user profile data using authentication header"""
     # Validate Clerk user ID from header
@@ -263,20 +395,13 @@ async def get_user_profile(
             detail="Invalid user ID from header"
         )
     
-    db = await get_database()
-    return await _get_profile_data(x_user_id, db)
+    return MongoJSONResponse(await _get_profile_data(x_user_id, db))
 
 @router.get("/{user_id}")
-async def get_user_by_id(user_id: str):
+async def get_user_by_id(user_id: str, db: AsyncDatabase = Depends(get_db)):
     """Get a specific user by ID"""
-    db = await get_database()
-    
-    # Try to find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    
-    # If not found and user_id looks like ObjectId, try as ObjectId
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -291,11 +416,10 @@ async def get_user_by_id(user_id: str):
 @router.post("")
 async def create_user(
     user_data: UserCreate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Create a new user with Clerk user ID"""
-    db = await get_database()
-    
     # Validate Clerk user ID format (should be a valid string identifier)
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -303,29 +427,19 @@ async def create_user(
             detail="Invalid user ID from Clerk"
         )
     
-    # Check if user with this Clerk ID already exists
-    existing_user = await db.users.find_one({"_id": x_user_id})
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="User already exists"
-        )
-    
-    # Check if user with email already exists
-    existing_email = await db.users.find_one({"email": user_data.email})
-    if existing_email:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="User with this email already exists"
-        )
+    # Check for an existing user with this Clerk ID, email or username in one query
+    unique_values = [("_id", x_user_id), ("email", user_data.email), ("username", user_data.username)]
+    unique_values = [(field, value) for field, value in unique_values if value]
+    conflicts = await db.users.find(
+        {"$or": [{field: value} for field, value in unique_values]},
+        {"_id": 1, "email": 1, "username": 1}
+    ).to_list(len(unique_values))
     
-    # Check if username already exists
-    if user_data.username:
-        existing_username = await db.users.find_one({"username": user_data.username})
-        if existing_username:
+    for field, value in unique_values:
+        if any(conflict.get(field) == value for conflict in conflicts):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already exists"
+                detail=USER_CONFLICT_DETAILS[field]
             )
     
     user_dict = user_data.dict()
@@ -333,20 +447,27 @@ async def create_user(
     user_dict["created_at"] = datetime.utcnow()
     user_dict["updated_at"] = datetime.utcnow()
     
-    await db.users.insert_one(user_dict)
+    # The unique indexes catch a concurrent create that slipped past the check above
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_duplicate_key_detail(e)
+        )
     
     # Return the created user
-    return await get_user_by_id(x_user_id)
+    user_dict["created_at"] = format_timestamp(user_dict["created_at"])
+    return convert_objectid_to_str(user_dict)
 
 @router.put("/{user_id}")
 async def update_user(
     user_id: str,
     user_update: UserUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update a user (only the user themselves can update their profile)"""
-    db = await get_database()
-    
     # Validate Clerk user ID from header
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -354,65 +475,48 @@ async def update_user(
             detail="Invalid user ID from header"
         )
     
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
-    
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
     # Only allow users to update their own profile
-    # Convert both IDs to string for comparison
-    actual_user_id = str(user["_id"])
-    if actual_user_id != x_user_id:
+    if user_id != x_user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You can only update your own profile"
         )
     
-    # Check if new email already exists (if being updated)
-    if user_update.email and user_update.email != user["email"]:
-        existing_email = await db.users.find_one({"email": user_update.email})
-        if existing_email:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already exists"
-            )
-    
-    # Check if new username already exists (if being updated)
-    if user_update.username and user_update.username != user.get("username"):
-        existing_username = await db.users.find_one({"username": user_update.username})
-        if existing_username:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already exists"
-            )
-    
     # Update user
     update_data = {k: v for k, v in user_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    # Use the actual user ID from the database for the update
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {"$set": update_data}
-    )
+    # Update and read back in one round trip; the unique indexes reject an email
+    # or username that belongs to someone else
+    try:
+        user = await db.users.find_one_and_update(
+            _user_id_query(x_user_id),
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_duplicate_key_detail(e, USER_UPDATE_CONFLICT_DETAILS)
+        )
+    
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
     
     # Return updated user
-    return await get_user_by_id(user_id)
+    user["created_at"] = format_timestamp(user["created_at"])
+    return convert_objectid_to_str(user)
 
 @router.delete("/{user_id}")
 async def delete_user(
     user_id: str,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Delete a user (only the user themselves can delete their account)"""
-    db = await get_database()
-    
     # Validate Clerk user ID from header
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -420,10 +524,8 @@ async def delete_user(
             detail="Invalid user ID from header"
         )
     
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -440,90 +542,131 @@ async def delete_user(
             detail="You can only delete your own account"
         )
     
-    # Delete user and all related content
-    await db.users.delete_one({"_id": user["_id"]})
-    
-    # Also delete user's blogs and community posts (using string representation of user ID)
-    await db.blogs.delete_many({"author_id": actual_user_id})
-    await db.community_posts.delete_many({"author_id": actual_user_id})
+    # Communities they created are deleted along with the account
+    created_communities = await db.communities.find({"creator_id": actual_user_id}, {"_id": 1, "members": 1}).to_list(None)
+    created_ids = [str(community["_id"]) for community in created_communities]
+    created_oids = [community["_id"] for community in created_communities]
+    
+    # The remaining members of the deleted communities lose one membership per
+    # community, applied as one write per member in a single bulk request
+    lost_memberships = Counter(
+        member
+        for community in created_communities
+        for member in community.get("members", [])
+        if member != actual_user_id
+    )
+    count_updates = [
+        UpdateOne(_user_id_query(member), {"$inc": {"communities_count": -count}})
+        for member, count in lost_memberships.items()
+    ]
     
-    # Remove user from communities they're members of
-    await db.communities.update_many(
-        {"members": actual_user_id},
-        {
-            "$pull": {"members": actual_user_id},
-            "$inc": {"member_count": -1}
-        }
+    # Delete user and all related content (these writes are independent)
+    await asyncio.gather(
+        db.users.delete_one({"_id": user["_id"]}),
+        # Blogs and community posts are keyed by the string representation of the user ID
+        db.blogs.delete_many({"author_id": actual_user_id}),
+        db.community_posts.delete_many({
+            "$or": [
+                {"author_id": actual_user_id},
+                {"community_id": {"$in": created_ids}}
+            ]
+        }),
+        # Remove user from communities they're members of
+        db.communities.update_many(
+            {"members": actual_user_id},
+            {
+                "$pull": {"members": actual_user_id},
+                "$inc": {"member_count": -1}
+            }
+        ),
+        db.communities.delete_many({"_id": {"$in": created_oids}}),
+        *([db.users.bulk_write(count_updates, ordered=False)] if count_updates else [])
     )
     
-    # Handle communities they created (transfer ownership or delete)
-    # For now, we'll delete communities they created
-    user_communities = await db.communities.find({"creator_id": actual_user_id}).to_list(None)
-    for community in user_communities:
-        community_id = str(community["_id"])
-        # Delete all posts in the community
-        await db.community_posts.delete_many({"community_id": community_id})
-        # Delete the community
-        await db.communities.delete_one({"_id": community["_id"]})
+    # Forget the cached ID mapping so this worker stops resolving the deleted account
+    _USER_ID_CACHE.pop(user_id, None)
+    _USER_ID_CACHE.pop(actual_user_id, None)
     
     return {"message": "User account and all associated data deleted successfully"}
 
 async def _get_profile_data(user_id: str, db):
     """Helper function to get profile data for a given user ID"""
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Load the user together with their blog statistics and recent activity in one
+    # round trip. Blogs and communities reference users by the string form of _id.
+    profile_pipeline = [
+        {"$match": _user_id_query(user_id)},
+        {"$limit": 1},
+        {"$addFields": {"uid": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "blogs",
+            "localField": "uid",
+            "foreignField": "author_id",
+            "pipeline": [
+                {"$group": {"_id": None, "count": {"$sum": 1}, "total_upvotes": {"$sum": "$upvotes"}}}
+            ],
+            "as": "blog_stats"
+        }},
+        # Recent blogs (latest 3)
+        {"$lookup": {
+            "from": "blogs",
+            "localField": "uid",
+            "foreignField": "author_id",
+            "pipeline": [
+                {"$sort": {"created_at": -1}},
+                {"$limit": 3},
+                {"$project": BLOG_LIST_PROJECTION}
+            ],
+            "as": "recent_blogs"
+        }},
+        # Recent communities (latest 3 where user is a member)
+        {"$lookup": {
+            "from": "communities",
+            "localField": "uid",
+            "foreignField": "members",
+            "pipeline": [
+                {"$sort": {"created_at": -1}},
+                {"$limit": 3},
+                {"$project": COMMUNITY_LIST_PROJECTION}
+            ],
+            "as": "recent_communities"
+        }}
+    ]
+    result = await _aggregate_to_list(db.users, profile_pipeline, 1)
     
-    if not user:
+    if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    # Get the actual user ID for database queries
-    actual_user_id = str(user["_id"])
+    user = result[0]
     
-    # Calculate user statistics
-    blogs_count = await db.blogs.count_documents({"author_id": actual_user_id})
-    
-    # Calculate total upvotes received on user's blogs
-    upvotes_pipeline = [
-        {"$match": {"author_id": actual_user_id}},
-        {"$group": {"_id": None, "total_upvotes": {"$sum": "$upvotes"}}}
-    ]
-    upvotes_result = await db.blogs.aggregate(upvotes_pipeline).to_list(1)
-    total_upvotes = upvotes_result[0]["total_upvotes"] if upvotes_result else 0
+    # Get the actual user ID for database queries
+    actual_user_id = user["uid"]
+    _USER_ID_CACHE[user_id] = actual_user_id
     
-    # Count communities user is a member of
-    communities_count = await db.communities.count_documents({"members": actual_user_id})
+    blog_stats = user["blog_stats"][0] if user["blog_stats"] else {}
+    blogs_count = blog_stats.get("count", 0)
+    total_upvotes = blog_stats.get("total_upvotes", 0)
+    recent_blogs = user["recent_blogs"]
+    recent_communities = user["recent_communities"]
     
-    # Count communities user created
-    created_communities_count = await db.communities.count_documents({"creator_id": actual_user_id})
+    # Community counts are denormalized onto the user document by the community
+    # create/join/leave/delete flows; existing users are backfilled once at startup
+    communities_count = user.get("communities_count", 0)
+    created_communities_count = user.get("created_communities_count", 0)
     
     # Calculate score (can be customized based on your scoring logic)
     score = (blogs_count * 10) + (total_upvotes * 5) + (communities_count * 2) + (created_communities_count * 15)
     
-    # Get recent blogs (latest 3)
-    recent_blogs = await db.blogs.find({"author_id": actual_user_id})\
-        .sort("created_at", -1)\
-        .limit(3)\
-        .to_list(3)
-    
     # Format recent blogs
+    now = datetime.utcnow()
     for blog in recent_blogs:
-        blog["created_at"] = format_timestamp(blog["created_at"])
-    
-    # Get recent communities (latest 3 where user is a member)
-    recent_communities = await db.communities.find({"members": actual_user_id})\
-        .sort("created_at", -1)\
-        .limit(3)\
-        .to_list(3)
+        blog["created_at"] = format_timestamp(blog["created_at"], now)
     
     # Format recent communities
     for community in recent_communities:
-        community["created_at"] = format_timestamp(community["created_at"])
+        community["created_at"] = format_timestamp(community["created_at"], now)
         community["user_role"] = "admin" if community["creator_id"] == actual_user_id else "member"
     
     # Build comprehensive profile data
@@ -535,8 +678,8 @@ async def _get_profile_data(user_id: str, db):
             "email": user["email"],
             "bio": user.get("bio", ""),
             "avatar": user.get("avatar", ""),
-            "created_at": format_timestamp(user["created_at"]),
-            "updated_at": format_timestamp(user.get("updated_at", user["created_at"]))
+            "created_at": format_timestamp(user["created_at"], now),
+            "updated_at": format_timestamp(user.get("updated_at", user["created_at"]), now)
         },
         "stats": {
             "blogs": blogs_count,
@@ -547,8 +690,8 @@ async def _get_profile_data(user_id: str, db):
             "created_communities": created_communities_count
         },
         "recent_activity": {
-            "blogs": convert_objectid_to_str(recent_blogs),
-            "communities": convert_objectid_to_str(recent_communities)
+            "blogs": recent_blogs,
+            "communities": recent_communities
         },
         "achievements": user.get("achievements", []),  # Placeholder for future achievements
         "preferences": {
@@ -563,15 +706,14 @@ async def _get_profile_data(user_id: str, db):
 async def get_user_blogs(
     user_id: str,
     page: int = Query(1, ge=1),
-    per_page: int = Query(10, ge=1, le=50)
+    per_page: int = Query(10, ge=1, le=50),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor (takes precedence over page)"),
+    include_total: bool = Query(False, description="Also return the total number of matches (capped at 10000)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get all blogs by a specific user"""
-    db = await get_database()
-    
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -579,21 +721,17 @@ async def get_user_blogs(
             detail="User not found"
         )
     
-    skip = (page - 1) * per_page
-    
     # Use the actual user ID from database for queries
     actual_user_id = str(user["_id"])
     
     # Get user's blogs
-    blogs = await db.blogs.find({"author_id": actual_user_id})\
-        .sort("created_at", -1)\
-        .skip(skip)\
-        .limit(per_page)\
-        .to_list(per_page)
-    
-    total_count = await db.blogs.count_documents({"author_id": actual_user_id})
+    blogs, total_count, next_cursor = await _find_page(
+        db.blogs, {"author_id": actual_user_id}, "created_at", -1, page, per_page, after, include_total,
+        projection=BLOG_LIST_PROJECTION
+    )
     
     # Add author info and format timestamps
+    now = datetime.utcnow()
     for blog in blogs:
         blog["author"] = {
             "id": actual_user_id,
@@ -602,13 +740,15 @@ async def get_user_blogs(
             "avatar": user.get("avatar", ""),
             "bio": user.get("bio", "")
         }
-        blog["created_at"] = format_timestamp(blog["created_at"])
+        blog["created_at"] = format_timestamp(blog["created_at"], now)
     
-    return {
-        "blogs": convert_objectid_to_str(blogs),
+    return MongoJSONResponse({
+        "blogs": blogs,
         "total": total_count,
         "page": page,
         "per_page": per_page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
         "author": {
             "id": actual_user_id,
             "name": user["name"],
@@ -616,7 +756,7 @@ async def get_user_blogs(
             "avatar": user.get("avatar", ""),
             "bio": user.get("bio", "")
         }
-    }
+    })
 
 @router.get("/{user_id}/communities")
 async def get_user_communities(
@@ -624,15 +764,14 @@ async def get_user_communities(
     page: int = Query(1, ge=1),
     per_page: int = Query(10, ge=1, le=50),
     membership_type: Optional[str] = Query(None, regex="^(created|joined|all)$"),
-    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc")
+    order_by: Optional[str] = Query("newest", description="Sort order: newest, oldest, most_members, least_members, alphabetical, alphabetical_desc"),
+    after: Optional[str] = Query(None, description="Cursor from a previous page's next_cursor (takes precedence over page)"),
+    include_total: bool = Query(False, description="Also return the total number of matches (capped at 10000)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Get communities associated with a user (created or joined) with sorting options"""
-    db = await get_database()
-    
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    # Match the user by string ID (Clerk ID) or ObjectId in a single query
+    user = await _find_user(db, user_id)
     
     if not user:
         raise HTTPException(
@@ -640,53 +779,35 @@ async def get_user_communities(
             detail="User not found"
         )
     
-    skip = (page - 1) * per_page
-    
     # Use the actual user ID from database for queries
     actual_user_id = str(user["_id"])
     
-    # Build filter based on membership type
-    if membership_type == "created":
-        filter_query = {"creator_id": actual_user_id}
-    elif membership_type == "joined":
-        filter_query = {"members": actual_user_id, "creator_id": {"$ne": actual_user_id}}
-    else:  # "all" or None
-        filter_query = {"members": actual_user_id}
-    
-    # Build sort criteria
-    sort_mapping = {
-        "newest": ("created_at", -1),
-        "oldest": ("created_at", 1),
-        "most_members": ("member_count", -1),
-        "least_members": ("member_count", 1),
-        "alphabetical": ("name", 1),
-        "alphabetical_desc": ("name", -1)
-    }
+    filter_query = _membership_filter(actual_user_id, membership_type)
     
     # Default to newest if invalid order_by provided
-    if order_by not in sort_mapping:
+    if order_by not in COMMUNITY_SORT_MAPPING:
         order_by = "newest"
     
-    sort_field, sort_direction = sort_mapping[order_by]
-    
-    communities = await db.communities.find(filter_query)\
-        .sort(sort_field, sort_direction)\
-        .skip(skip)\
-        .limit(per_page)\
-        .to_list(per_page)
+    sort_field, sort_direction = COMMUNITY_SORT_MAPPING[order_by]
     
-    total_count = await db.communities.count_documents(filter_query)
+    communities, total_count, next_cursor = await _find_page(
+        db.communities, filter_query, sort_field, sort_direction, page, per_page, after, include_total,
+        projection=COMMUNITY_LIST_PROJECTION
+    )
     
     # Add user's role in each community and format timestamps
+    now = datetime.utcnow()
     for community in communities:
         community["user_role"] = "admin" if community["creator_id"] == actual_user_id else "member"
-        community["created_at"] = format_timestamp(community["created_at"])
+        community["created_at"] = format_timestamp(community["created_at"], now)
     
-    return {
-        "communities": convert_objectid_to_str(communities),
+    return MongoJSONResponse({
+        "communities": communities,
         "total": total_count,
         "page": page,
         "per_page": per_page,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
         "user": {
             "id": actual_user_id,
             "name": user["name"],
@@ -694,58 +815,56 @@ async def get_user_communities(
         },
         "membership_type": membership_type or "all",
         "order_by": order_by
-    }
+    })
 
 # PRESENCE ENDPOINTS
 
+def _presence_response(presence: dict) -> PresenceResponse:
+    """Build the API response for a user_presence document"""
+    return PresenceResponse(
+        user_id=presence["user_id"],
+        status=presence["status"],
+        custom_message=presence.get("custom_message"),
+        last_seen=format_timestamp(presence["last_seen"]),
+        updated_at=format_timestamp(presence["updated_at"])
+    )
+
 @router.get("/{user_id}/presence")
-async def get_user_presence(user_id: str):
+async def get_user_presence(user_id: str, db: AsyncDatabase = Depends(get_db)):
     """Get user's current presence status"""
-    db = await get_database()
-    
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    actual_user_id = await _resolve_user_id(db, user_id)
     
-    if not user:
+    if not actual_user_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    # Get user presence from presence collection
-    presence = await db.user_presence.find_one({"user_id": str(user["_id"])})
-    
-    if not presence:
-        # Create default offline presence if not exists
-        default_presence = {
-            "user_id": str(user["_id"]),
+    # Get user presence from presence collection, atomically creating the default
+    # offline presence if it doesn't exist yet
+    now = datetime.utcnow()
+    presence = await db.user_presence.find_one_and_update(
+        {"user_id": actual_user_id},
+        {"$setOnInsert": {
             "status": PresenceStatus.OFFLINE,
             "custom_message": None,
-            "last_seen": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-        await db.user_presence.insert_one(default_presence)
-        presence = default_presence
-    
-    return PresenceResponse(
-        user_id=presence["user_id"],
-        status=presence["status"],
-        custom_message=presence.get("custom_message"),
-        last_seen=format_timestamp(presence["last_seen"]),
-        updated_at=format_timestamp(presence["updated_at"])
+            "last_seen": now,
+            "updated_at": now
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    
+    return _presence_response(presence)
 
 @router.put("/{user_id}/presence")
 async def update_user_presence(
     user_id: str,
     presence_update: PresenceUpdate,
-    x_user_id: str = Header(..., description="User ID from Clerk (frontend)")
+    x_user_id: str = Header(..., description="User ID from Clerk (frontend)"),
+    db: AsyncDatabase = Depends(get_db)
 ):
     """Update user's presence status"""
-    db = await get_database()
-    
     # Validate Clerk user ID from header
     if not x_user_id or len(x_user_id.strip()) == 0:
         raise HTTPException(
@@ -753,19 +872,14 @@ async def update_user_presence(
             detail="Invalid user ID from header"
         )
     
-    # Find user by string ID first (Clerk ID), then by ObjectId if needed
-    user = await db.users.find_one({"_id": user_id})
-    if not user and ObjectId.is_valid(user_id):
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
+    actual_user_id = await _resolve_user_id(db, user_id)
     
-    if not user:
+    if not actual_user_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    actual_user_id = str(user["_id"])
-    
     # Only allow users to update their own presence
     if actual_user_id != x_user_id:
         raise HTTPException(
@@ -785,12 +899,15 @@ async def update_user_presence(
     if presence_update.status == PresenceStatus.ONLINE:
         update_data["last_seen"] = now
     
-    # Upsert presence record
-    await db.user_presence.update_one(
+    # Upsert presence record and return the updated document
+    update = {"$set": update_data}
+    if "last_seen" not in update_data:
+        update["$setOnInsert"] = {"last_seen": now}
+    presence = await db.user_presence.find_one_and_update(
         {"user_id": actual_user_id},
-        {"$set": update_data},
-        upsert=True
+        update,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
     
-    # Return updated presence
-    return await get_user_presence(actual_user_id) 
\ No newline at end of file
+    return _presence_response(presence) 
\ No newline at end of file
@@ -0,0 +1,42 @@
+from functools import lru_cache
+import os
+import threading
+
+import firebase_admin
+from firebase_admin import credentials, storage as fb_storage
+
+_init_lock = threading.Lock()
+
+def _firebase_credentials() -> dict:
+    """Service account credentials assembled from the FIREBASE_* environment"""
+    # Keys pasted into .env files carry literal "\\n" escapes; real PEM needs no copy
+    private_key = os.getenv("FIREBASE_PRIVATE_KEY") or ""
+    if "\\n" in private_key:
+        private_key = private_key.replace("\\n", "\n")
+    return {
+        "type": os.getenv("FIREBASE_TYPE"),
+        "project_id": os.getenv("FIREBASE_PROJECT_ID"),
+        "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
+        "private_key": private_key,
+        "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
+        "client_id": os.getenv("FIREBASE_CLIENT_ID"),
+        "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
+        "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
+        "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_X509_CERT_URL"),
+        "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL"),
+        "universe_domain": os.getenv("FIREBASE_UNIVERSE_DOMAIN"),
+    }
+
+@lru_cache(maxsize=1)
+def get_bucket():
+    """Return the Firebase Storage bucket, initialising the SDK on first use
+
+    Workers that never handle an upload never parse the service account key.
+    """
+    # Uploads may run in worker threads, so only one of them initialises the app
+    with _init_lock:
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(_firebase_credentials())
+            bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET', 'your-bucket-name.appspot.com')
+            firebase_admin.initialize_app(cred, {'storageBucket': bucket_name})
+    return fb_storage.bucket()
@@ -1,24 +1,56 @@
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
-from math import ceil
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from itertools import islice
+import base64
+import re
+from bson import ObjectId, json_util
+from bson.errors import BSONError
 
-def format_timestamp(dt: datetime) -> str:
-    """Format datetime to human-readable timestamp like '2 days ago'"""
-    now = datetime.utcnow()
-    diff = now - dt
+# Image content types accepted by the upload endpoints
+ALLOWED_IMAGE_TYPES = frozenset({"image/jpeg", "image/png", "image/jpg", "image/webp"})
+
+# Leaf types convert_objectid_to_str can skip without further checks
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None), datetime})
+
+# (upper bound in seconds, unit, divisor) for format_timestamp; anything
+# older than the last bound is shown as a date
+_TIME_BUCKETS = (
+    (60, None, 60),
+    (3600, "minute", 60),
+    (86400, "hour", 3600),
+    (8 * 86400, "day", 86400),
+)
+_PLURAL_SUFFIX = ("", "s")
+
+# Types a decoded pagination cursor value may have (bool and Int64 are int subclasses)
+_CURSOR_VALUE_TYPES = (str, int, float, datetime, ObjectId)
+
+# Script blocks and inline on* handlers stripped by sanitize_html, in one pass
+_SANITIZE_RE = re.compile(
+    r"""<script[^>]*>.*?</script>|on\w+="[^"]*"|on\w+='[^']*'""",
+    re.DOTALL | re.IGNORECASE
+)
+
+def format_timestamp(dt: datetime, now: Optional[datetime] = None) -> str:
+    """Format datetime to human-readable timestamp like '2 days ago'
+
+    Pass ``now`` when formatting many timestamps for one response so the
+    clock is read once for the whole batch.
+    """
+    total_seconds = int(((now or datetime.utcnow()) - dt).total_seconds())
     
-    if diff.days > 7:
-        return dt.strftime("%B %d, %Y")
-    elif diff.days > 0:
-        return f"{diff.days} day{'s' if diff.days > 1 else ''} ago"
-    elif diff.seconds > 3600:
-        hours = diff.seconds // 3600
-        return f"{hours} hour{'s' if hours > 1 else ''} ago"
-    elif diff.seconds > 60:
-        minutes = diff.seconds // 60
-        return f"{minutes} minute{'s' if minutes > 1 else ''} ago"
-    else:
+    for threshold, unit, divisor in _TIME_BUCKETS:
+        if total_seconds < threshold:
+            return _fmt_bucket(unit, total_seconds // divisor)
+    return dt.strftime("%B %d, %Y")
+
+@lru_cache(maxsize=1024)
+def _fmt_bucket(unit: Optional[str], n: int) -> str:
+    """Relative time string for a bucketed difference, memoized per bucket"""
+    if unit is None:
         return "Just now"
+    return f"{n} {unit}{_PLURAL_SUFFIX[n > 1]} ago"
 
 def create_pagination_info(
     total_items: int,
@@ -26,7 +58,7 @@ def create_pagination_info(
     per_page: int
 ) -> Dict[str, Any]:
     """Create pagination information"""
-    total_pages = ceil(total_items / per_page)
+    total_pages = (total_items + per_page - 1) // per_page if per_page else 0
     has_next = page < total_pages
     has_prev = page > 1
     
@@ -39,49 +71,93 @@ def create_pagination_info(
         "has_prev": has_prev
     }
 
-def search_filter(items: List[Dict[str, Any]], query: str, fields: List[str]) -> List[Dict[str, Any]]:
-    """Filter items based on search query in specified fields"""
+def encode_cursor(doc: Dict[str, Any], sort_field: str) -> str:
+    """Encode the sort key and _id of a document as an opaque pagination cursor"""
+    payload = json_util.dumps({"v": doc.get(sort_field), "id": doc["_id"]})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(token: str) -> Dict[str, Any]:
+    """Decode a cursor produced by encode_cursor, raising ValueError if it is malformed"""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        cursor = {"v": payload["v"], "id": payload["id"]}
+    except (ValueError, KeyError, TypeError, BSONError) as e:
+        raise ValueError("Invalid pagination cursor") from e
+    
+    # The values go straight into a query, so anything that could smuggle in an
+    # operator (documents, arrays) is rejected
+    for value in cursor.values():
+        if value is not None and not isinstance(value, _CURSOR_VALUE_TYPES):
+            raise ValueError("Invalid pagination cursor")
+    return cursor
+
+def search_filter(
+    items: Iterable[Dict[str, Any]],
+    query: str,
+    fields: List[str],
+    limit: Optional[int] = None
+) -> Iterator[Dict[str, Any]]:
+    """Lazily yield items matching the search query in any of the specified fields
+    
+    Stops scanning once ``limit`` matches have been yielded; callers that paginate
+    can also take a slice with itertools.islice(search_filter(...), per_page).
+    """
     if not query:
-        return items
+        yield from islice(items, limit or None)
+        return
     
-    query_lower = query.lower()
-    filtered_items = []
+    # A case-insensitive pattern scans each field in C without lowercased copies.
+    # Fields are checked in the given order, so pass short fields (e.g. title) first.
+    pattern = re.compile(re.escape(query), re.IGNORECASE)
     
+    count = 0
     for item in items:
-        for field in fields:
-            field_value = item.get(field, "")
-            if isinstance(field_value, str) and query_lower in field_value.lower():
-                filtered_items.append(item)
-                break
-    
-    return filtered_items
+        if any(
+            isinstance(field_value, str) and pattern.search(field_value)
+            for field_value in (item.get(field, "") for field in fields)
+        ):
+            yield item
+            count += 1
+            if limit and count >= limit:
+                return
 
 def sanitize_html(content: str) -> str:
     """Basic HTML sanitization - in production, use a proper library like bleach"""
     # This is a basic implementation - use bleach or similar library in production
-    import re
     
     # Allow basic HTML tags
     allowed_tags = ['p', 'br', 'strong', 'em', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
     
-    # Remove script tags and their content
-    content = re.sub(r'<script[^>]*>.*?</script>', '', content, flags=re.DOTALL | re.IGNORECASE)
-    
-    # Remove dangerous attributes
-    content = re.sub(r'on\w+="[^"]*"', '', content, flags=re.IGNORECASE)
-    content = re.sub(r"on\w+='[^']*'", '', content, flags=re.IGNORECASE)
+    # Remove script tags and their content and dangerous attributes. Repeat while
+    # anything was removed, since a removal can splice a new match together
+    # (e.g. "o<script></script>nclick=...")
+    removed = 1
+    while removed:
+        content, removed = _SANITIZE_RE.subn('', content)
     
     return content
 
 def convert_objectid_to_str(obj: Any) -> Any:
-    """Convert MongoDB ObjectId to string in nested objects"""
-    from bson import ObjectId
+    """Convert MongoDB ObjectId to string in nested objects
     
+    Dicts and lists are updated in place (callers convert documents they are about to
+    return), so nothing is copied and subtrees without ObjectIds are only walked.
+    """
     if isinstance(obj, ObjectId):
         return str(obj)
-    elif isinstance(obj, dict):
-        return {key: convert_objectid_to_str(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_objectid_to_str(item) for item in obj]
-    else:
-        return obj 
\ No newline at end of file
+    if not obj or not isinstance(obj, (dict, list)):
+        return obj
+    
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        entries = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, value in entries:
+            if type(value) in _SCALAR_TYPES:
+                continue
+            if isinstance(value, ObjectId):
+                container[key] = str(value)
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+    
+    return obj
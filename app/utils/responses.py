@@ -0,0 +1,23 @@
+from typing import Any
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+def _bson_default(obj: Any) -> Any:
+    """Serialize the BSON types orjson doesn't know about"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class MongoJSONResponse(JSONResponse):
+    """JSON response that serializes MongoDB documents directly with orjson
+    
+    This is the app's default response class. Returning one from a handler also
+    skips FastAPI's jsonable_encoder pass, and ObjectIds are rendered as strings
+    while encoding, so the documents don't need to go through
+    convert_objectid_to_str first.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        # Like json.dumps, write non-string dict keys as strings instead of failing
+        return orjson.dumps(content, default=_bson_default, option=orjson.OPT_NON_STR_KEYS)